@@ -19,6 +19,43 @@
 # 2023-04-20 - Compiled for Ubuntu 20.04 and changed BPL_version
 # 2023-05-31 - Adjusted to from importlib.meetadata import version
 # 2023-09-11 - Updated to FMU-explore 0.9.8 and introduced proces diagram
+# 2026-10-19 - Added fit() for parameter estimation with simu_case() and worker processes with warm FMU instances
+# 2026-10-19 - Added fit_ms() for parameter estimation by multiple shooting with segments in parallel
+# 2026-10-19 - Added fit_multi() for parameter estimation from many experiments with global and local parameters
+# 2026-10-19 - Added mcmc() for posterior sampling of parameters with an ensemble sampler and checkpoints
+# 2026-10-19 - Added linearize() for A, B, C, D matrices at many time points in one pass and benchmark_linearize()
+# 2026-10-19 - Added bayes_opt() for Bayesian optimization with batches of candidates and the result cache simu_cache
+# 2026-10-19 - Added nsga2() for the Pareto front of productivity, yield and feed over the dosage scheme
+# 2026-10-19 - Added sweep() and a surrogate model of trajectories that simu() uses within its trained domain
+# 2026-10-19 - Added ensemble_simu() a NumPy ensemble integrator of the model selectable in sweep() and ensemble_validate()
+# 2026-10-19 - Added parareal() for parallel-in-time simulation with mode 'parareal' of simu() and benchmark_parareal()
+# 2026-10-19 - Added simu_map_prefix() so that sweep() simulates the start shared by cases only once
+# 2026-10-19 - Added simu_horizon_result() so that simu() reuses results with the same parameters for a shorter or longer simulationTime
+# 2026-10-19 - Changed simu() in mode 'cont' to set the parameters from parDict_restart()
+# 2026-10-19 - Added checkpoints after each simu() and rollback() to undo simulations without simulating again
+# 2026-10-19 - Added save_checkpoint() and load_checkpoint() to continue a simulation from a file
+# 2026-10-19 - Added fmu_extract() with a cache of the extracted FMU shared by processes and used by the worker processes
+# 2026-10-19 - Added simu_pool_start() with worker processes kept warm and forked from a template with the FMU loaded
+# 2026-10-19 - Added simu_ensemble() with FMU instances on a thread pool and benchmark_ensemble() against worker processes
+# 2026-10-19 - Added class FMUSession with state of its own and par(), init(), simu(), disp() and describe() for concurrent sessions
+# 2026-10-19 - Added simu_async() and sweep_async() for asyncio with cancellation, progress and a bounded thread pool
+# 2026-10-19 - Added simu_stream() that yields results every k output intervals while the simulation runs
+# 2026-10-19 - Added simu_progressive() and simu(mode='progressive') with a coarse run shown at once and refined in the background
+# 2026-10-19 - Added stop conditions on variables for simu(), simu_case(), sweep() and sweep_async() that end a simulation early
+# 2026-10-19 - Added solver_tune() with solver profiles interactive, sweep and reference that simu(options=...) takes by name
+# 2026-10-19 - Added benchmark_bayes_opt() that compares bayes_opt() with a grid search
+# 2026-10-19 - Changed simu_cache_key() to include the time where simu_map_prefix() split a result
+# 2026-10-19 - Changed simu() to reuse results by simu_horizon_result() only after simu_horizon_use()
+# 2026-10-19 - Changed simu_checkpoint() and rollback() to keep and restore sim_res and start_values
+# 2026-10-19 - Removed the FMU state from save_checkpoint() and load_checkpoint(), the simulation continues from stateDict
+# 2026-10-19 - Changed fmu_cache_evict() to skip extractions in progress and remove an extraction only while holding its lock
+# 2026-10-19 - Changed benchmark_ensemble() to vary all positive parameters of parDict with sweep_design()
+# 2026-10-19 - Changed par(), init(), simu(), disp() and describe() to use the default FMUSession fmu_session, with the model specific part of describe() as describe_model()
+# 2026-10-19 - Changed simu_progressive() to report a failed full resolution run, and simu_refine_cancel() to warn when the coarse result is kept
+# 2026-10-19 - Kept the stop condition and time of simu() in sim_stop and of sweep() in 'stop' and 'stop_time' apart from the arrays
+# 2026-10-19 - Changed mcmc_autocorr() to give at least 1, or nan when the chain is too short for the window
+# 2026-10-19 - Changed the coarse propagator of parareal() to CVode with the loose relative tolerance 1e-2
+# 2026-10-19 - Changed solver_tune() to compare runtimes against the timing noise and keep the loosest candidate that meets a target
 #------------------------------------------------------------------------------------------------------------------
 
 #------------------------------------------------------------------------------------------------------------------
@@ -33,6 +70,24 @@ import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.image as img
 import zipfile 
+import queue
+import asyncio
+import threading
+import concurrent.futures
+import shutil
+import tempfile
+try:
+   import fcntl
+except ImportError:
+   fcntl = None
+import re
+import hashlib
+import ctypes
+import xml.etree.ElementTree as ET
+import json
+import os
+import time
+import multiprocessing
 
 from fmpy import simulate_fmu
 from fmpy import read_model_description
@@ -318,7 +373,7 @@ def newplot(title='Fedbatch cultivation', plotType='TimeSeries'):
       print("Plot window type not correct")
 
 # Define describtions partly coded here and partly taken from the FMU
-def describe(name, decimals=3):
+def describe_model(name, decimals=3):
    """Look up description of culture, media, as well as parameters and variables in the model code"""
         
    if name == 'culture':
@@ -355,34 +410,19 @@ FMU_explore = 'FMU-explore for FMPy version 0.9.8'
 #------------------------------------------------------------------------------------------------------------------
 
 # Define function par() for parameter update
-def par(parDict=parDict, parCheck=parCheck, parLocation=parLocation, *x, **x_kwarg):
+def par(*x, **x_kwarg):
    """ Set parameter values if available in the predefined dictionaryt parDict. """
-   x_kwarg.update(*x)
-   x_temp = {}
-   for key in x_kwarg.keys():
-      if key in parDict.keys():
-         x_temp.update({key: x_kwarg[key]})
-      else:
-         print('Error:', key, '- seems not an accessible parameter - check the spelling')
-   parDict.update(x_temp)
-   
-   parErrors = [requirement for requirement in parCheck if not(eval(requirement))]
-   if not parErrors == []:
-      print('Error - the following requirements do not hold:')
-      for index, item in enumerate(parErrors): print(item)
+   fmu_session.par(*x, **x_kwarg)
 
 # Define function init() for initial values update
-def init(parDict=parDict, *x, **x_kwarg):
-   """ Set initial values and the name should contain string '_0' to be accepted.
-       The function can handle general parameter string location names if entered as a dictionary. """
-   x_kwarg.update(*x)
-   x_init={}
-   for key in x_kwarg.keys():
-      if '_0' in key: 
-         x_init.update({key: x_kwarg[key]})
-      else:
-         print('Error:', key, '- seems not an initial value, use par() instead - check the spelling')
-   parDict.update(x_init)
+def init(*x, **x_kwarg):
+   """ Set initial values and the name should contain string '_0' to be accepted. """
+   fmu_session.init(*x, **x_kwarg)
+
+# Define function describe() for description of parameters and variables
+def describe(name, decimals=3):
+   """Look up description of culture, media, as well as parameters and variables in the model code"""
+   fmu_session.describe(name, decimals)
 
 # Define fuctions similar to pyfmi model.get(), model.get_variable_descirption(), model.get_variable_unit()
 def model_get(parLoc, model_description=model_description):
@@ -399,7 +439,7 @@ def model_get(parLoc, model_description=model_description):
                try:
                   timeSeries = sim_res[par_var[k].name]
                   value = timeSeries[-1]
-               except (AttributeError, ValueError):
+               except (AttributeError, ValueError, KeyError):
                   value = None
                   print('Variable not logged')
             else:
@@ -425,45 +465,9 @@ def model_get_variable_unit(parLoc, model_description=model_description):
       
 # Define function disp() for display of initial values and parameters
 def disp(name='', decimals=3, mode='short'):
-   """ Display intial values and parameters in the model that include "name" and is in parLocation list.
-       Note, it does not take the value from the dictionary par but from the model. """
-   
-   def dict_reverser(d):
-      seen = set()
-      return {v: k for k, v in d.items() if v not in seen or seen.add(v)}
-   
-   if mode in ['short']:
-      k = 0
-      for Location in [parLocation[k] for k in parDict.keys()]:
-         if name in Location:
-            if type(model_get(Location)) != np.bool_:
-               print(dict_reverser(parLocation)[Location] , ':', np.round(model_get(Location),decimals))
-            else:
-               print(dict_reverser(parLocation)[Location] , ':', model_get(Location))               
-         else:
-            k = k+1
-      if k == len(parLocation):
-         for parName in parDict.keys():
-            if name in parName:
-               if type(model_get(Location)) != np.bool_:
-                  print(parName,':', np.round(model_get(parLocation[parName]),decimals))
-               else: 
-                  print(parName,':', model_get(parLocation[parName])[0])
-
-   if mode in ['long','location']:
-      k = 0
-      for Location in [parLocation[k] for k in parDict.keys()]:
-         if name in Location:
-            if type(model_get(Location)) != np.bool_:       
-               print(Location,':', dict_reverser(parLocation)[Location] , ':', np.round(model_get(Location),decimals))
-         else:
-            k = k+1
-      if k == len(parLocation):
-         for parName in parDict.keys():
-            if name in parName:
-               if type(model_get(Location)) != np.bool_:
-                  print(parLocation[parName], ':', dict_reverser(parLocation)[Location], ':', parName,':', 
-                     np.round(model_get(parLocation[parName]),decimals))
+   """ Display intial values and parameters in parDict that include "name" in the short name or in the
+       location in parLocation. With mode 'long' the location is shown too. """
+   fmu_session.disp(name, decimals, mode)
 
 # Line types
 def setLines(lines=['-','--',':','-.']):
@@ -480,99 +484,11 @@ def show(diagrams=diagrams):
    for command in diagrams: eval(command)
 
 # Define simulation
-def simu(simulationTime=simulationTime, mode='Initial', options=opts_std, diagrams=diagrams):
-   """Model loaded and given intial values and parameter before, and plot window also setup before."""   
-   
-   # Global variables
-   global sim_res, prevFinalTime, stateDict, stateDictInitial, stateDictInitialLoc, start_values
-   
-   # Simulation flag
-   simulationDone = False
-   
-   # Internal help function to extract variables to be stored
-   def extract_variables(diagrams):
-       output = []
-       variables = [v for v in model_description.modelVariables if v.causality == 'local']
-       for j in range(len(diagrams)):
-           for k in range(len(variables)):
-               if variables[k].name in diagrams[j]:
-                   output.append(variables[k].name)
-       return output
-
-   # Run simulation
-   if mode in ['Initial', 'initial', 'init']: 
-      
-      start_values = {parLocation[k]:parDict[k] for k in parDict.keys()}
-      
-      # Simulate
-      sim_res = simulate_fmu(
-         filename = fmu_model,
-         validate = False,
-         start_time = 0,
-         stop_time = simulationTime,
-         output_interval = simulationTime/options['ncp'],
-         record_events = True,
-         start_values = start_values,
-         fmi_call_logger = None,
-         output = list(set(extract_variables(diagrams) + list(stateDict.keys()) + key_variables))
-      )
-      
-      simulationDone = True
-      
-   elif mode in ['Continued', 'continued', 'cont']:
-      
-      if prevFinalTime == 0: 
-         print("Error: Simulation is first done with default mode = init'")
-         
-      else:         
-         # Update parDictMod and create parLocationMod
-         parDictRed = parDict.copy()
-         parLocationRed = parLocation.copy()
-         for key in parDict.keys():
-            if parLocation[key] in stateDictInitial.values(): 
-               del parDictRed[key]  
-               del parLocationRed[key]
-         parLocationMod = dict(list(parLocationRed.items()) + list(stateDictInitialLoc.items()))
-   
-         # Create parDictMod and parLocationMod
-         parDictMod = dict(list(parDictRed.items()) + 
-            [(stateDictInitial[key], stateDict[key]) for key in stateDict.keys()])      
+def simu(simulationTime=simulationTime, mode='Initial', options=opts_std, diagrams=diagrams, stop=None):
+   """Model loaded and given intial values and parameter before, and plot window also setup before.
+      The simulation is that of the default session fmu_session, see FMUSession.simu()."""
+   fmu_session.simu(simulationTime, mode, options, diagrams=diagrams, stop=stop)
 
-         start_values = {parLocationMod[k]:parDictMod[k] for k in parDictMod.keys()}
-  
-         # Simulate
-         sim_res = simulate_fmu(
-            filename = fmu_model,
-            validate = False,
-            start_time = prevFinalTime,
-            stop_time = prevFinalTime + simulationTime,
-            output_interval = simulationTime/options['ncp'],
-            record_events = True,
-            start_values = start_values,
-            fmi_call_logger = None,
-            output = list(set(extract_variables(diagrams) + list(stateDict.keys()) + key_variables))
-         )
-      
-         simulationDone = True
-   else:
-      
-      print("Error: Simulation mode not correct")
-
-   if simulationDone:
-      
-      # Plot diagrams from simulation
-      linetype = next(linecycler)    
-      for command in diagrams: eval(command)
-   
-      # Store final state values in stateDict:        
-      for key in stateDict.keys(): stateDict[key] = model_get(key)  
-         
-      # Store time from where simulation will start next time
-      prevFinalTime = sim_res['time'][-1]
-      
-   else:
-      print('Error: No simulation done')
-            
 # Describe model parts of the combined system
 def describe_parts(component_list=[]):
    """List all parts of the model""" 
@@ -706,6 +622,3138 @@ def system_info():
    print(' -Description:', BPL_version)   
    print(' -Interaction:', FMU_explore)
    
+# Extraction of the FMU to a cache directory shared by all processes
+global fmu_cache_dir; fmu_cache_dir = os.path.join(tempfile.gettempdir(), 'fmu_explore_cache')
+global fmu_cache_max_age; fmu_cache_max_age = 30*24*3600
+global fmu_cache_max_size; fmu_cache_max_size = 2*1024**3
+global fmu_extracted; fmu_extracted = {}
+
+def fmu_extract(path=fmu_model):
+   """Directory where the FMU is extracted in fmu_cache_dir under its SHA-256. The FMU is extracted once
+      and then shared by all processes, also of later sessions. A lock file keeps processes from extracting
+      at the same time and the extraction is renamed into place when complete."""
+   if (path in fmu_extracted.keys()) and os.path.isdir(fmu_extracted[path]): return fmu_extracted[path]
+   os.makedirs(fmu_cache_dir, exist_ok=True)
+   directory = os.path.join(fmu_cache_dir, fmu_hash(path))
+   if not os.path.isdir(directory):
+      with open(directory + '.lock', 'w') as lock:
+         if fcntl is not None: fcntl.flock(lock, fcntl.LOCK_EX)
+         try:
+            if not os.path.isdir(directory):
+               directory_tmp = tempfile.mkdtemp(prefix='.extract_', dir=fmu_cache_dir)
+               with zipfile.ZipFile(path) as fmu: fmu.extractall(directory_tmp)
+               try:
+                  os.rename(directory_tmp, directory)
+               except OSError:
+                  shutil.rmtree(directory_tmp, ignore_errors=True)
+         finally:
+            if fcntl is not None: fcntl.flock(lock, fcntl.LOCK_UN)
+      fmu_cache_evict(keep=directory)
+   try:
+      os.utime(directory)
+   except FileNotFoundError:
+      return fmu_extract(path)
+   except OSError:
+      pass
+   fmu_extracted[path] = directory
+   return directory
+
+def fmu_cache_evict(keep=None, max_age=None, max_size=None):
+   """Remove extractions in fmu_cache_dir not used for max_age seconds, default fmu_cache_max_age, and
+      then the least recently used until the rest takes at most max_size bytes, default fmu_cache_max_size.
+      Extractions in progress and those locked by another process are left in place."""
+   if max_age is None: max_age = fmu_cache_max_age
+   if max_size is None: max_size = fmu_cache_max_size
+   entries = []
+   for name in os.listdir(fmu_cache_dir):
+      directory = os.path.join(fmu_cache_dir, name)
+      if name.startswith('.extract_') or (directory == keep): continue
+      try:
+         if not os.path.isdir(directory): continue
+         size = sum([os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(directory) for file in files])
+         entries.append((os.path.getmtime(directory), size, directory))
+      except OSError:
+         continue
+   total = sum([size for _, size, _ in entries])
+   now = time.time()
+   for used, size, directory in sorted(entries):
+      if (now - used > max_age) or (total > max_size):
+         if fmu_cache_remove(directory): total = total - size
+
+def fmu_cache_remove(directory):
+   """Remove an extraction in fmu_cache_dir while holding its lock file, False if another process holds
+      the lock or the extraction cannot be removed"""
+   try:
+      with open(directory + '.lock', 'w') as lock:
+         if fcntl is not None:
+            try:
+               fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+               return False
+         shutil.rmtree(directory)
+         os.remove(directory + '.lock')
+   except OSError:
+      return False
+   return True
+
+# Warm FMU instances of this process: fmu_instance for linearization and free instances for simu_case()
+global fmu_instance; fmu_instance = None
+global fmu_instances_free; fmu_instances_free = []
+
+def fmu_instantiate():
+   """New FMU instance from the extracted FMU"""
+   return fmpy.instantiate_fmu(fmu_extract(), model_description)
+
+def simu_worker_init(instances=1):
+   """Extract and instantiate the FMU once in this process, then reused by simu_case(), with instances
+      free instances ready for fmu_checkout()"""
+   global fmu_instance
+   if fmu_instance is None: fmu_instance = fmu_instantiate()
+   while len(fmu_instances_free) < instances: fmu_instances_free.append(fmu_instantiate())
+
+def fmu_checkout():
+   """Free warm FMU instance for one simulation, a new instance if all are in use"""
+   try:
+      return fmu_instances_free.pop()
+   except IndexError:
+      return fmu_instantiate()
+
+def fmu_checkin(instance):
+   """Reset the instance after a simulation and make it free again. An instance that cannot be reset
+      is dropped."""
+   try:
+      instance.reset()
+   except Exception:
+      return
+   fmu_instances_free.append(instance)
+
+# Parameters that act only from the time in another parameter, used to share the start of simulations
+global parActsAfter
+parActsAfter = {'t_start': 't_start', 'F_start': 't_start', 'mu_feed': 't_start', 'F_max': 't_start'}
+
+# Parameters for a restart from states at a later time
+def parDict_restart(parDictCase, start_time):
+   """Parameters in parDictCase adjusted for a simulation that starts from states at start_time. The FMU
+      does not keep that the feed has started, so a feed start before start_time is moved to start_time
+      with the feed rate reached by then."""
+   parDictCase = parDictCase.copy()
+   if parDictCase['t_start'] < start_time:
+      parDictCase['F_start'] = min(parDictCase['F_start']*np.exp(parDictCase['mu_feed']*(start_time - parDictCase['t_start'])),
+                                   parDictCase['F_max'])
+      parDictCase['t_start'] = start_time
+   return parDictCase
+
+# Simulation of a case without use of the global variables of simu()
+def simu_case(parDictCase, simulationTime, output, options=opts_std, start_time=0, stateDictCase=None,
+              step_finished=None, keep=True, stop=None):
+   """Simulate with the parameters and initial values in parDictCase, that use the same keys as parDict,
+      and return a dictionary with time and the variables in output as numpy arrays. If stateDictCase
+      is given the simulation starts from these states at start_time, as simu() does in mode 'cont',
+      with the parameters from parDict_restart().
+      Besides 'ncp' the options may have solver, step_size and relative_tolerance of simulate_fmu().
+      If step_finished is given it is called after each step with the time and a dictionary of the
+      samples since the previous call, and the simulation stops when it returns False. With keep False
+      these samples are dropped and the result has only the samples after the last call.
+      If stop is given, conditions as 'feedtank.V <= 0', the simulation ends at the first sample where
+      one holds, and the result has the condition in 'stop' and its time in 'stop_time', else None,
+      that simu_stop_split() takes apart from the arrays."""
+
+   if stop is not None:
+      conditions = simu_stop_conditions(stop)
+      if conditions is None: return None
+      record = {'stop': None, 'stop_time': None}
+      output = list(dict.fromkeys(list(output) + [condition['name'] for condition in conditions]))
+      res = simu_case(parDictCase, simulationTime, output, options, start_time, stateDictCase,
+                      simu_stop_step(conditions, record, step_finished), keep)
+      res.update(record)
+      return res
+
+   instance = fmu_checkout()
+
+   if stateDictCase is None:
+      start_values = {parLocation[k]:parDictCase[k] for k in parDictCase.keys()}
+   else:
+      parDictCase = parDict_restart(parDictCase, start_time)
+      start_values = {parLocation[k]:parDictCase[k] for k in parDictCase.keys()
+                      if parLocation[k] not in stateDictInitial.values()}
+      start_values.update({stateDictInitial[key]:stateDictCase[key] for key in stateDictCase.keys()})
+
+   # Samples of the recorder handed to step_finished as arrays
+   step = None
+   if step_finished is not None:
+      seen = [0]
+      def step(time, recorder):
+         rows = recorder.rows[seen[0]:]
+         if keep:
+            seen[0] = len(recorder.rows)
+         else:
+            del recorder.rows[:]
+         names = [col[0] for col in recorder.cols]
+         values = np.array(rows, dtype=float).reshape(len(rows), len(names))
+         return step_finished(time, {name: values[:,names.index(name)] for name in ['time'] + list(output)})
+
+   try:
+      res = simulate_fmu(
+         filename = fmu_extract(),
+         validate = False,
+         start_time = start_time,
+         stop_time = start_time + simulationTime,
+         output_interval = simulationTime/options['ncp'],
+         solver = options.get('solver', 'CVode'),
+         step_size = options.get('step_size'),
+         relative_tolerance = options.get('relative_tolerance'),
+         record_events = True,
+         start_values = start_values,
+         fmi_call_logger = None,
+         output = list(output),
+         step_finished = step,
+         model_description = model_description,
+         fmu_instance = instance
+      )
+   finally:
+      fmu_checkin(instance)
+   return {name: np.array(res[name]) for name in ['time'] + list(output)}
+
+# Worker processes for parallel simulation
+global simu_pool_warm; simu_pool_warm = None
+
+def simu_pool(workers=None, instances=1):
+   """Start a pool of worker processes each with warm FMU instances that are reused between simulations.
+      The FMU is first extracted and instantiated in this process, that then is the template the workers
+      are forked from, so they start with the FMU loaded and all functions and dictionaries of this script.
+      Returns the pool of simu_pool_start() if it has at least workers, and None if only one worker
+      is asked for or fork is not available, and then simulations are done in this process."""
+   if workers is None: workers = os.cpu_count()
+   if (simu_pool_warm is not None) and (simu_pool_warm['workers'] >= workers): return simu_pool_warm['pool']
+   if (workers <= 1) or ('fork' not in multiprocessing.get_all_start_methods()): return None
+   simu_worker_init(instances)
+   return multiprocessing.get_context('fork').Pool(workers, initializer=simu_worker_init, initargs=(instances,))
+
+def simu_pool_start(workers=None, instances=1):
+   """Start worker processes that are kept and used by all later sweeps, estimations and optimizations,
+      so that the start of the workers is paid once. The workers keep the script as it is now, so
+      restart them after changes of functions. Stop them with simu_pool_stop()."""
+   global simu_pool_warm
+   simu_pool_stop()
+   if workers is None: workers = os.cpu_count()
+   pool = simu_pool(workers, instances)
+   if pool is None:
+      print('Error: simu_pool_start() needs at least two workers and fork')
+      return None
+   simu_pool_warm = {'pool': pool, 'workers': workers}
+   return pool
+
+def simu_pool_stop():
+   """Stop the worker processes of simu_pool_start()"""
+   global simu_pool_warm
+   if simu_pool_warm is not None:
+      simu_pool_warm['pool'].terminate()
+      simu_pool_warm['pool'].join()
+      simu_pool_warm = None
+
+def simu_pool_release(pool):
+   """Close a pool from simu_pool() after use, except the pool kept by simu_pool_start()"""
+   if (pool is not None) and ((simu_pool_warm is None) or (pool is not simu_pool_warm['pool'])):
+      pool.close()
+      pool.join()
+
+def simu_case_kwargs(kwargs):
+   """Help function for the pool with simu_case() arguments as a dictionary"""
+   return simu_case(**kwargs)
+
+def simu_map(cases, pool=None):
+   """Simulate a list of cases, each a dictionary of arguments to simu_case(), and return the results
+      in the same order. The cases are shared among the workers of the pool if given."""
+   if pool is None:
+      return [simu_case_kwargs(case) for case in cases]
+   else:
+      return pool.map(simu_case_kwargs, cases, chunksize=1)
+
+# Ensemble of FMU instances in this process advanced by a thread pool
+def simu_ensemble(parDicts, simulationTime=simulationTime, output=None, threads=None, options=opts_std):
+   """ Simulate the parameter sets in the list parDicts, with the same keys as parDict, by threads FMU
+       instances in this process on a thread pool. The FMU code and the script are shared by the
+       instances, so this needs less memory than worker processes, and the threads run in parallel
+       where the FMU calls release the GIL. The globals of simu() are not touched.
+       Returns a dictionary with time and an array for each variable in output, default the states,
+       with one row per parameter set, all allocated before the simulations start. """
+
+   if output is None: output = list(stateDict.keys())
+   if threads is None: threads = min(len(parDicts), os.cpu_count())
+   threads = max(threads, 1)
+   simu_worker_init(threads)
+
+   t = np.linspace(0, simulationTime, options['ncp'] + 1)
+   buffers = {name: np.empty((len(parDicts), len(t))) for name in output}
+
+   def run(k):
+      res = simu_case(parDicts[k], simulationTime, output, options)
+      for name in output:
+         if len(res['time']) == len(t):
+            buffers[name][k,:] = res[name]
+         else:
+            buffers[name][k,:] = np.interp(t, res['time'], res[name])
+
+   with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+      list(executor.map(run, range(len(parDicts))))
+
+   result = {'time': t}
+   result.update(buffers)
+   return result
+
+def memory_rss(pid=None):
+   """Resident set size in MB of the process pid, default this process, from /proc, or None if not available"""
+   try:
+      with open('/proc/' + ('self' if pid is None else str(pid)) + '/status') as f:
+         for line in f:
+            if line.startswith('VmRSS:'): return int(line.split()[1])/1024
+   except OSError:
+      return None
+   return None
+
+def benchmark_ensemble(n=40, threads=None, workers=None, simulationTime=simulationTime, options=opts_std):
+   """ Simulate n parameter sets with the positive parameters of parDict varied by up to 10% with
+       sweep_design(), first with simu_ensemble() on threads FMU instances in this process and then with
+       simu_map() on workers worker processes, and report the throughput and the resident memory of each. For the worker processes the memory is summed over all processes,
+       with shared pages counted in each. """
+
+   bounds = {key: (0.9*value, 1.1*value) for key, value in parDict.items() if value > 0}
+   parDicts = [dict(parDict, **values) for values in sweep_design(bounds, n, seed=0)]
+   output = list(stateDict.keys())
+   if threads is None: threads = os.cpu_count()
+   if workers is None: workers = os.cpu_count()
+
+   rss_start = memory_rss()
+   tic = time.time()
+   simu_ensemble(parDicts, simulationTime, output, threads, options)
+   time_threads = time.time() - tic
+   rss_threads = memory_rss()
+
+   cases = [{'parDictCase': parDictCase, 'simulationTime': simulationTime, 'output': output, 'options': options}
+            for parDictCase in parDicts]
+   pool = simu_pool(workers)
+   tic = time.time()
+   try:
+      simu_map(cases, pool)
+      rss_processes = memory_rss()
+      if pool is not None:
+         rss_processes = rss_processes + sum([memory_rss(process.pid) or 0 for process in multiprocessing.active_children()])
+   finally:
+      simu_pool_release(pool)
+   time_processes = time.time() - tic
+
+   print()
+   print('Ensemble of', n, 'simulations')
+   print(' -Threads in this process :', threads, ' ', np.round(n/time_threads, 1), 'simulations/s  RSS',
+         np.round(rss_threads, 1) if rss_threads is not None else '-', 'MB')
+   print(' -Worker processes        :', 1 if pool is None else workers, ' ', np.round(n/time_processes, 1),
+         'simulations/s  RSS', np.round(rss_processes, 1) if rss_processes is not None else '-', 'MB')
+   if rss_start is not None: print(' -RSS before:', np.round(rss_start, 1), 'MB')
+   return {'time_threads': time_threads, 'time_processes': time_processes, 'rss_start': rss_start,
+           'rss_threads': rss_threads, 'rss_processes': rss_processes}
+
+# Measured data for parameter estimation
+def data_load(data):
+   """Load measured time series from a CSV-file with column names in the first row and 'time' as one
+      column, or take a dictionary of arrays. Column names are short names in parLocation, e.g. 'mu',
+      or model variable names. Missing values are given as empty fields or nan."""
+   if isinstance(data, str):
+      table = np.genfromtxt(data, delimiter=',', names=True, deletechars='', dtype=float)
+      data = {name: table[name] for name in table.dtype.names}
+   data = {key: np.atleast_1d(np.asarray(value, dtype=float)) for key, value in data.items()}
+   if 'time' not in data.keys():
+      print('Error: measured data must have a column time')
+      return None
+   for key in list(data.keys()):
+      if key == 'time':
+         continue
+      elif key in parLocation.keys():
+         data[parLocation[key]] = data.pop(key)
+      elif key not in [v.name for v in model_description.modelVariables]:
+         print('Error:', key, '- seems not a variable in the model - check the spelling')
+         return None
+   return data
+
+# Parameter estimation
+def fit_problem(data, params, bounds=None, weights=None):
+   """Common set up of measured data, weights and bounds for fit() and fit_ms()"""
+   data = data_load(data)
+   if data is None: return None
+   for key in params:
+      if key not in parDict.keys():
+         print('Error:', key, '- seems not an accessible parameter - check the spelling')
+         return None
+
+   # Measured variables, weights and mask for missing values
+   output = [key for key in data.keys() if key != 'time']
+   if weights is None: weights = {}
+   weights = {parLocation.get(key, key): value for key, value in weights.items()}
+   w = {}
+   for name in output:
+      w[name] = weights.get(name, 1/max(np.nanmax(np.abs(data[name])), 1e-12))
+   measured = {name: ~np.isnan(data[name]) for name in output}
+
+   if bounds is None: bounds = {}
+   lower = np.array([bounds.get(key, (0, np.inf))[0] for key in params], dtype=float)
+   upper = np.array([bounds.get(key, (0, np.inf))[1] for key in params], dtype=float)
+   x0 = np.clip(np.array([parDict[key] for key in params], dtype=float), lower, upper)
+
+   return {'data': data, 'output': output, 'w': w, 'measured': measured,
+           'finalTime': float(np.max(data['time'])), 'lower': lower, 'upper': upper, 'x0': x0}
+
+def fit(data, params, bounds=None, weights=None, workers=None, options=opts_std, diff_step=1e-4,
+        max_nfev=100, verbose=True):
+   """ Fit the parameters in the list params, e.g. ['Y', 'qSmax', 'Ks'], to measured data by weighted
+       least squares with a trust-region optimizer, starting from the values in parDict.
+        data    = CSV-file or dictionary of time series, see data_load()
+        bounds  = dictionary of (lower, upper) for each parameter, default (0, inf)
+        weights = dictionary of weights for each column, default 1/max(abs(column))
+        workers = number of worker processes for the Jacobian columns, default one per parameter
+       The Jacobian is evaluated by finite differences with one simulation per column in parallel.
+       The result is a dictionary with the estimates, covariance and runtime statistics, and parDict
+       is updated with the estimates. """
+
+   try:
+      from scipy.optimize import least_squares
+   except ImportError:
+      print('Error: fit() needs scipy')
+      return None
+
+   problem = fit_problem(data, params, bounds, weights)
+   if problem is None: return None
+   data, output, w, measured = problem['data'], problem['output'], problem['w'], problem['measured']
+   finalTime, lower, upper, x0 = problem['finalTime'], problem['lower'], problem['upper'], problem['x0']
+
+   def case(x):
+      parDictCase = parDict.copy()
+      parDictCase.update(dict(zip(params, [float(value) for value in x])))
+      return {'parDictCase': parDictCase, 'simulationTime': finalTime, 'output': output,
+              'options': options}
+
+   def residuals(res):
+      r = [w[name]*(np.interp(data['time'], res['time'], res[name]) - data[name])[measured[name]]
+           for name in output]
+      return np.concatenate(r)
+
+   # Last evaluated point is reused for the Jacobian at the same point
+   stats = {'simulations': 0, 'x': None, 'r': None}
+
+   def fun(x):
+      if (stats['x'] is None) or not np.array_equal(x, stats['x']):
+         stats['x'] = np.array(x)
+         stats['r'] = residuals(simu_case(**case(x)))
+         stats['simulations'] = stats['simulations'] + 1
+      return stats['r']
+
+   def jac(x):
+      r0 = fun(x)
+      h = diff_step*np.maximum(np.abs(x), 1e-3)
+      h = np.where(x + h > upper, -h, h)
+      cases = []
+      for j in range(len(x)):
+         xj = np.array(x)
+         xj[j] = xj[j] + h[j]
+         cases.append(case(xj))
+      results = simu_map(cases, pool)
+      stats['simulations'] = stats['simulations'] + len(cases)
+      return np.column_stack([(residuals(results[j]) - r0)/h[j] for j in range(len(x))])
+
+   if workers is None: workers = min(len(params), os.cpu_count())
+   pool = simu_pool(workers)
+   tic = time.time()
+   try:
+      res = least_squares(fun, x0, jac=jac, bounds=(lower, upper), method='trf', x_scale='jac',
+                          max_nfev=max_nfev)
+   finally:
+      simu_pool_release(pool)
+   toc = time.time()
+
+   # Covariance of the estimates from the Jacobian at the solution
+   m, n = res.fun.size, res.x.size
+   s2 = 2*res.cost/max(m - n, 1)
+   covariance = s2*np.linalg.pinv(res.jac.T @ res.jac)
+   std = np.sqrt(np.abs(np.diag(covariance)))
+
+   estimates = dict(zip(params, [float(value) for value in res.x]))
+   par(**estimates)
+
+   result = {'parameters': estimates,
+             'std': dict(zip(params, std)),
+             'covariance': covariance,
+             'cost': res.cost,
+             'success': res.success,
+             'message': res.message,
+             'nfev': res.nfev,
+             'njev': res.njev,
+             'simulations': stats['simulations'],
+             'workers': 1 if pool is None else workers,
+             'time': toc - tic}
+
+   if verbose:
+      print()
+      print('Parameter estimation:', res.message)
+      for k, key in enumerate(params):
+         print(' -'+key, ':', np.round(res.x[k], 4), '+/-', np.round(std[k], 4))
+      print(' -Residual sum of squares:', np.round(2*res.cost, 6), ' measurements:', m)
+      print(' -Iterations:', res.nfev, ' Jacobian evaluations:', res.njev,
+            ' simulations:', stats['simulations'])
+      print(' -Runtime:', np.round(toc - tic, 2), 's with', result['workers'], 'worker processes')
+   return result
+
+# Parameter estimation by multiple shooting
+def fit_ms(data, params, bounds=None, weights=None, segments=4, workers=None, options=opts_std,
+           diff_step=1e-4, maxiter=50, xtol=1e-6, verbose=True):
+   """ Fit the parameters in the list params to measured data as fit() but by multiple shooting.
+       The time horizon is cut into segments and each segment after the first starts from states,
+       as stateDict in simu() mode 'cont', that are extra decision variables. Continuity of the states
+       at the segment boundaries is enforced as equality constraints in a Gauss-Newton method where
+       Levenberg-Marquardt damping limits the step as a trust region.
+       The segments are simulated in parallel by worker processes, default one per segment.
+       Note that as in mode 'cont' only the continuous states are transferred, so segments should
+       start before time events of the model, e.g. t_start of the dosage scheme.
+       The result is a dictionary with the estimates, covariance and runtime statistics, and parDict
+       is updated with the estimates. """
+
+   problem = fit_problem(data, params, bounds, weights)
+   if problem is None: return None
+   data, output, w, measured = problem['data'], problem['output'], problem['w'], problem['measured']
+   finalTime, lower, upper, x0 = problem['finalTime'], problem['lower'], problem['upper'], problem['x0']
+
+   states = list(stateDict.keys())
+   n_par, n_state = len(params), len(states)
+   t_seg = np.linspace(0, finalTime, segments+1)
+   output_seg = list(dict.fromkeys(output + states))
+
+   # Measurements that belong to each segment, the last segment includes the final time
+   in_seg = []
+   for k in range(segments):
+      if k < segments-1:
+         in_seg.append((data['time'] >= t_seg[k]) & (data['time'] < t_seg[k+1]))
+      else:
+         in_seg.append((data['time'] >= t_seg[k]) & (data['time'] <= t_seg[k+1]))
+
+   def case(x, k, s):
+      parDictCase = parDict.copy()
+      parDictCase.update(dict(zip(params, [float(value) for value in x])))
+      return {'parDictCase': parDictCase, 'simulationTime': t_seg[k+1] - t_seg[k], 'output': output_seg,
+              'options': options, 'start_time': t_seg[k],
+              'stateDictCase': None if k == 0 else dict(zip(states, [float(value) for value in s]))}
+
+   # Initial states of the segments from a simulation over the whole horizon with the initial guess
+   res = simu_case(**case(x0, 0, None))
+   s0 = np.array([[np.interp(t_seg[k], res['time'], res[state]) for state in states]
+                  for k in range(1, segments)])
+   scale = np.maximum(np.max(np.abs(s0), axis=0), 1e-6) if segments > 1 else np.ones(n_state)
+
+   # Decision variables z are the parameters followed by the scaled initial states of segment 1, 2, ...
+   def split(z):
+      x = z[:n_par]
+      s = z[n_par:].reshape(segments-1, n_state)*scale
+      return x, s
+
+   def pieces(k, res):
+      r = [w[name]*(np.interp(data['time'], res['time'], res[name]) - data[name])[measured[name] & in_seg[k]]
+           for name in output]
+      return np.concatenate(r), np.array([res[state][-1] for state in states])
+
+   def assemble(segment_pieces, s):
+      r = np.concatenate([segment_pieces[k][0] for k in range(segments)])
+      c = [(segment_pieces[k][1] - s[k])/scale for k in range(segments-1)]
+      return r, np.concatenate(c) if segments > 1 else np.zeros(0)
+
+   stats = {'simulations': 0, 'iterations': 0}
+   cache = {}
+
+   def evaluate(z):
+      key = z.tobytes()
+      if key not in cache.keys():
+         x, s = split(z)
+         results = simu_map([case(x, k, s[k-1] if k > 0 else None) for k in range(segments)], pool)
+         stats['simulations'] = stats['simulations'] + segments
+         segment_pieces = [pieces(k, results[k]) for k in range(segments)]
+         cache.clear()
+         cache[key] = {'pieces': segment_pieces, 'rc': assemble(segment_pieces, s)}
+      return cache[key]
+
+   def jacobian(z):
+      base = evaluate(z)
+      if 'jac' not in base.keys():
+         x, s = split(z)
+         h = diff_step*np.maximum(np.abs(z), 1e-3)
+         h[:n_par] = np.where(x + h[:n_par] > upper, -h[:n_par], h[:n_par])
+
+         # A parameter affects all segments while initial states only affect their own segment
+         columns = []
+         cases = []
+         for j in range(z.size):
+            zj = np.array(z)
+            zj[j] = zj[j] + h[j]
+            xj, sj = split(zj)
+            affected = range(segments) if j < n_par else [1 + (j - n_par)//n_state]
+            columns.append((j, zj, list(affected)))
+            cases = cases + [case(xj, k, sj[k-1] if k > 0 else None) for k in affected]
+         results = simu_map(cases, pool)
+         stats['simulations'] = stats['simulations'] + len(cases)
+
+         r0, c0 = base['rc']
+         J_r = np.zeros((r0.size, z.size))
+         J_c = np.zeros((c0.size, z.size))
+         i = 0
+         for j, zj, affected in columns:
+            segment_pieces = list(base['pieces'])
+            for k in affected:
+               segment_pieces[k] = pieces(k, results[i])
+               i = i + 1
+            r, c = assemble(segment_pieces, split(zj)[1])
+            J_r[:,j] = (r - r0)/h[j]
+            J_c[:,j] = (c - c0)/h[j]
+         base['jac'] = (J_r, J_c)
+      return base['jac']
+
+   # Merit function with penalty on the continuity constraints for the step acceptance
+   def merit(z, rho):
+      r, c = evaluate(z)['rc']
+      return 0.5*np.dot(r, r) + rho*np.sum(np.abs(c))
+
+   z = np.concatenate([x0, (s0/scale).flatten()])
+   z_lower = np.concatenate([lower, -np.inf*np.ones((segments-1)*n_state)])
+   z_upper = np.concatenate([upper, np.inf*np.ones((segments-1)*n_state)])
+
+   if workers is None: workers = min(segments, os.cpu_count())
+   pool = simu_pool(workers)
+   tic = time.time()
+   try:
+      # Constrained Gauss-Newton where the Levenberg-Marquardt damping mu acts as trust-region radius
+      mu = 1e-3
+      rho = 1.0
+      success = False
+      message = 'Maximum number of iterations reached'
+      for iteration in range(maxiter):
+         r, c = evaluate(z)['rc']
+         J_r, J_c = jacobian(z)
+         H = J_r.T @ J_r
+         g = J_r.T @ r
+         D = np.diag(np.maximum(np.diag(H), 1e-12))
+         while True:
+            kkt = np.block([[H + mu*D, J_c.T], [J_c, np.zeros((c.size, c.size))]])
+            solution = np.linalg.lstsq(kkt, -np.concatenate([g, c]), rcond=None)[0]
+            dz, multipliers = solution[:z.size], solution[z.size:]
+            rho = max(rho, 2*np.max(np.abs(multipliers))) if multipliers.size > 0 else rho
+            z_new = np.clip(z + dz, z_lower, z_upper)
+            if merit(z_new, rho) < merit(z, rho):
+               mu = max(mu/3, 1e-9)
+               break
+            mu = mu*4
+            if mu > 1e10: break
+         stats['iterations'] = stats['iterations'] + 1
+         step = np.max(np.abs(z_new - z)/np.maximum(np.abs(z), 1e-3))
+         if mu > 1e10:
+            success = np.max(np.abs(c), initial=0.0) < 1e-6
+            message = 'No further decrease of the merit function'
+            break
+         z = z_new
+         if step < xtol:
+            success = True
+            message = 'Relative step smaller than xtol'
+            break
+      toc = time.time()
+      r, c = evaluate(z)['rc']
+      J_r, J_c = jacobian(z)
+   finally:
+      simu_pool_release(pool)
+
+   # Covariance of the estimates from the constrained Gauss-Newton system at the solution
+   kkt = np.block([[J_r.T @ J_r, J_c.T], [J_c, np.zeros((c.size, c.size))]])
+   s2 = np.dot(r, r)/max(r.size - n_par, 1)
+   covariance = s2*np.linalg.pinv(kkt)[:n_par,:n_par]
+   std = np.sqrt(np.abs(np.diag(covariance)))
+
+   x, s = split(z)
+   estimates = dict(zip(params, [float(value) for value in x]))
+   par(**estimates)
+
+   iterations = max(stats['iterations'], 1)
+   result = {'parameters': estimates,
+             'std': dict(zip(params, std)),
+             'covariance': covariance,
+             'cost': 0.5*np.dot(r, r),
+             'success': success,
+             'message': message,
+             'segments': segments,
+             'segment_states': s,
+             'continuity': np.max(np.abs(c)) if c.size > 0 else 0.0,
+             'iterations': stats['iterations'],
+             'simulations': stats['simulations'],
+             'workers': 1 if pool is None else workers,
+             'time': toc - tic,
+             'time_per_iteration': (toc - tic)/iterations}
+
+   if verbose:
+      print()
+      print('Parameter estimation by multiple shooting:', message)
+      for k, key in enumerate(params):
+         print(' -'+key, ':', np.round(x[k], 4), '+/-', np.round(std[k], 4))
+      print(' -Residual sum of squares:', np.round(np.dot(r, r), 6), ' measurements:', r.size)
+      print(' -Segments:', segments, ' max continuity error:', np.round(result['continuity'], 8))
+      print(' -Iterations:', stats['iterations'], ' simulations:', stats['simulations'])
+      print(' -Runtime:', np.round(toc - tic, 2), 's and', np.round(result['time_per_iteration'], 3),
+            's per iteration with', result['workers'], 'worker processes')
+   return result
+
+# Parameter estimation from many experiments
+def fit_multi(experiments, params, local=[], bounds=None, weights=None, workers=None, options=opts_std,
+              diff_step=1e-4, max_nfev=100, verbose=True):
+   """ Fit parameters to many experiments at once, e.g. batches with different initial values and feed.
+        experiments = list of dictionaries with
+                       'data' - CSV-file or dictionary of time series, see data_load()
+                       'par'  - dictionary of parDict values of the experiment, e.g. V_0 and feed settings
+        params      = global parameters shared by all experiments, e.g. ['Y', 'qSmax', 'Ks']
+        local       = parameters estimated for each experiment, e.g. ['VX_0', 'VS_0']
+        bounds      = dictionary of (lower, upper) for each parameter, default (0, inf)
+        weights     = dictionary of weights for each column, default 1/max(abs(column))
+       All experiments are simulated concurrently by the worker processes in each evaluation. The Jacobian
+       is block sparse since a local parameter only affects its own experiment, and the number of
+       simulations per Jacobian grows linearly with the number of experiments. The result is a
+       dictionary with global and local estimates, covariance and runtime statistics, and parDict
+       is updated with the global estimates. """
+
+   try:
+      from scipy.optimize import least_squares
+      from scipy.sparse import lil_matrix
+   except ImportError:
+      print('Error: fit_multi() needs scipy')
+      return None
+
+   for key in list(params) + list(local):
+      if key not in parDict.keys():
+         print('Error:', key, '- seems not an accessible parameter - check the spelling')
+         return None
+   if weights is None: weights = {}
+   weights = {parLocation.get(key, key): value for key, value in weights.items()}
+   if bounds is None: bounds = {}
+
+   # Measured data, weights and mask for missing values of each experiment
+   n_exp, n_glob, n_loc = len(experiments), len(params), len(local)
+   exp = []
+   for e, experiment in enumerate(experiments):
+      data = data_load(experiment['data'])
+      if data is None: return None
+      parDictExp = parDict.copy()
+      parDictExp.update(experiment.get('par', {}))
+      output = [key for key in data.keys() if key != 'time']
+      w = {name: weights.get(name, 1/max(np.nanmax(np.abs(data[name])), 1e-12)) for name in output}
+      measured = {name: ~np.isnan(data[name]) for name in output}
+      exp.append({'data': data, 'parDict': parDictExp, 'output': output, 'w': w, 'measured': measured,
+                  'finalTime': float(np.max(data['time'])),
+                  'size': sum([np.sum(measured[name]) for name in output])})
+   rows = np.cumsum([0] + [exp[e]['size'] for e in range(n_exp)])
+
+   # Decision variables are the global parameters followed by the local parameters of each experiment
+   names = list(params) + [key for e in range(n_exp) for key in local]
+   lower = np.array([bounds.get(key, (0, np.inf))[0] for key in names], dtype=float)
+   upper = np.array([bounds.get(key, (0, np.inf))[1] for key in names], dtype=float)
+   x0 = [parDict[key] for key in params] + [exp[e]['parDict'][key] for e in range(n_exp) for key in local]
+   x0 = np.clip(np.array(x0, dtype=float), lower, upper)
+
+   def case(x, e):
+      parDictCase = exp[e]['parDict'].copy()
+      parDictCase.update(dict(zip(params, [float(value) for value in x[:n_glob]])))
+      x_loc = x[n_glob + e*n_loc:n_glob + (e+1)*n_loc]
+      parDictCase.update(dict(zip(local, [float(value) for value in x_loc])))
+      return {'parDictCase': parDictCase, 'simulationTime': exp[e]['finalTime'],
+              'output': exp[e]['output'], 'options': options}
+
+   def residuals(res, e):
+      data, w, measured = exp[e]['data'], exp[e]['w'], exp[e]['measured']
+      r = [w[name]*(np.interp(data['time'], res['time'], res[name]) - data[name])[measured[name]]
+           for name in exp[e]['output']]
+      return np.concatenate(r)
+
+   # Last evaluated point is reused for the Jacobian at the same point
+   stats = {'simulations': 0, 'x': None, 'r': None}
+
+   def fun(x):
+      if (stats['x'] is None) or not np.array_equal(x, stats['x']):
+         results = simu_map([case(x, e) for e in range(n_exp)], pool)
+         stats['simulations'] = stats['simulations'] + n_exp
+         stats['x'] = np.array(x)
+         stats['r'] = [residuals(results[e], e) for e in range(n_exp)]
+      return np.concatenate(stats['r'])
+
+   def jac(x):
+      fun(x)
+      r0 = stats['r']
+      h = diff_step*np.maximum(np.abs(x), 1e-3)
+      h = np.where(x + h > upper, -h, h)
+
+      # Global parameters affect all experiments and local parameters only their own experiment
+      columns = []
+      for j in range(x.size):
+         affected = range(n_exp) if j < n_glob else [(j - n_glob)//n_loc]
+         for e in affected:
+            columns.append((j, e))
+      cases = []
+      for j, e in columns:
+         xj = np.array(x)
+         xj[j] = xj[j] + h[j]
+         cases.append(case(xj, e))
+      results = simu_map(cases, pool)
+      stats['simulations'] = stats['simulations'] + len(cases)
+
+      J = lil_matrix((rows[-1], x.size))
+      for i, (j, e) in enumerate(columns):
+         J[rows[e]:rows[e+1], j] = ((residuals(results[i], e) - r0[e])/h[j]).reshape(-1, 1)
+      return J.tocsr()
+
+   if workers is None: workers = min(n_exp, os.cpu_count())
+   pool = simu_pool(workers)
+   tic = time.time()
+   try:
+      res = least_squares(fun, x0, jac=jac, bounds=(lower, upper), method='trf', x_scale='jac',
+                          tr_solver='lsmr', max_nfev=max_nfev)
+   finally:
+      simu_pool_release(pool)
+   toc = time.time()
+
+   # Covariance of the estimates from the Jacobian at the solution
+   m, n = res.fun.size, res.x.size
+   J = res.jac.toarray()
+   s2 = 2*res.cost/max(m - n, 1)
+   covariance = s2*np.linalg.pinv(J.T @ J)
+   std = np.sqrt(np.abs(np.diag(covariance)))
+
+   estimates = dict(zip(params, [float(value) for value in res.x[:n_glob]]))
+   par(**estimates)
+   estimates_local = [dict(zip(local, [float(value) for value in res.x[n_glob + e*n_loc:n_glob + (e+1)*n_loc]]))
+                      for e in range(n_exp)]
+   std_local = [dict(zip(local, std[n_glob + e*n_loc:n_glob + (e+1)*n_loc])) for e in range(n_exp)]
+
+   result = {'parameters': estimates,
+             'std': dict(zip(params, std[:n_glob])),
+             'local': estimates_local,
+             'std_local': std_local,
+             'covariance': covariance,
+             'cost': res.cost,
+             'success': res.success,
+             'message': res.message,
+             'nfev': res.nfev,
+             'njev': res.njev,
+             'simulations': stats['simulations'],
+             'workers': 1 if pool is None else workers,
+             'time': toc - tic}
+
+   if verbose:
+      print()
+      print('Parameter estimation from', n_exp, 'experiments:', res.message)
+      for k, key in enumerate(params):
+         print(' -'+key, ':', np.round(res.x[k], 4), '+/-', np.round(std[k], 4))
+      for e in range(n_exp):
+         if n_loc > 0:
+            print(' -Experiment', e, ':', {key: float(np.round(value, 4)) for key, value in estimates_local[e].items()})
+      print(' -Residual sum of squares:', np.round(2*res.cost, 6), ' measurements:', m)
+      print(' -Iterations:', res.nfev, ' Jacobian evaluations:', res.njev,
+            ' simulations:', stats['simulations'])
+      print(' -Runtime:', np.round(toc - tic, 2), 's with', result['workers'], 'worker processes')
+   return result
+
+# Posterior sampling of parameters by Markov chain Monte Carlo
+def simu_case_try(kwargs):
+   """Help function for the pool as simu_case_kwargs() but returns None if the simulation fails"""
+   try:
+      return simu_case(**kwargs)
+   except Exception:
+      return None
+
+def mcmc_autocorr(chain):
+   """Integrated autocorrelation time of each parameter in a chain with shape (steps, walkers, n),
+      estimated from the walker mean with an automatic window, at least 1, or nan if the chain is too
+      short for the window"""
+   steps = chain.shape[0]
+   tau = []
+   for j in range(chain.shape[2]):
+      y = np.mean(chain[:,:,j], axis=1)
+      y = y - np.mean(y)
+      if steps < 4 or np.dot(y, y) == 0:
+         tau.append(np.nan)
+         continue
+      f = np.fft.rfft(y, n=2*steps)
+      acf = np.fft.irfft(f*np.conj(f))[:steps]
+      acf = acf/acf[0]
+      taus = 2*np.cumsum(acf) - 1
+      window = np.arange(steps) >= 5*taus
+      tau.append(max(taus[np.argmax(window)], 1.0) if np.any(window) else np.nan)
+   return np.array(tau)
+
+def mcmc(data, params, bounds=None, sigma=None, walkers=None, steps=500, burn=None, workers=None,
+         options=opts_std, checkpoint=None, checkpoint_every=10, spread=1e-2, a=2.0, seed=None,
+         verbose=True):
+   """ Sample the posterior distribution of the parameters in the list params, e.g. ['Y', 'qSmax', 'Ks'],
+       given measured data with an affine-invariant ensemble sampler (stretch move of Goodman and Weare).
+       The walkers start in a small ball around the values in parDict, preferably the result of fit().
+        data       = CSV-file or dictionary of time series, see data_load()
+        bounds     = dictionary of (lower, upper) for each parameter, uniform prior, default (0, inf)
+        sigma      = dictionary of the measurement standard deviation of each column, default a common
+                     relative standard deviation estimated from the residuals at the start values
+        walkers    = number of walkers, even and at least 2*len(params), default 4*len(params)
+        steps      = number of steps of the ensemble, including steps of a resumed checkpoint
+        burn       = number of first steps left out of the summary, default steps//2
+        checkpoint = npz-file where the chain is saved every checkpoint_every steps and resumed from
+       The ensemble is updated in two halves and the likelihood of all proposals of a half is evaluated
+       concurrently by the worker processes. Proposals already evaluated are taken from a cache.
+       The result is a dictionary with the chain, posterior mean, standard deviation and quantiles,
+       and sampling statistics. parDict is not changed. """
+
+   problem = fit_problem(data, params, bounds, None)
+   if problem is None: return None
+   data, output, w, measured = problem['data'], problem['output'], problem['w'], problem['measured']
+   finalTime, lower, upper, x0 = problem['finalTime'], problem['lower'], problem['upper'], problem['x0']
+
+   n = len(params)
+   if walkers is None: walkers = 4*n
+   walkers = max(walkers + walkers % 2, 2*n + 2*(n % 2))
+   if burn is None: burn = steps//2
+
+   def case(x):
+      parDictCase = parDict.copy()
+      parDictCase.update(dict(zip(params, [float(value) for value in x])))
+      return {'parDictCase': parDictCase, 'simulationTime': finalTime, 'output': output,
+              'options': options}
+
+   def sum_squares(res):
+      if res is None: return np.inf
+      r = [w[name]*(np.interp(data['time'], res['time'], res[name]) - data[name])[measured[name]]
+           for name in output]
+      r = np.concatenate(r)
+      return np.dot(r, r) if np.all(np.isfinite(r)) else np.inf
+
+   # Measurement noise as weights that make the residuals of unit variance
+   m = sum([np.sum(measured[name]) for name in output])
+   if sigma is not None:
+      sigma = {parLocation.get(key, key): value for key, value in sigma.items()}
+      for name in output:
+         if name not in sigma.keys():
+            print('Error:', name, '- has no standard deviation in sigma')
+            return None
+         w[name] = 1/sigma[name]
+      s2 = 1.0
+   else:
+      s2 = sum_squares(simu_case(**case(x0)))/max(m - n, 1)
+      if not np.isfinite(s2) or s2 <= 0:
+         print('Error: the residuals at the start values do not give a noise estimate - give sigma')
+         return None
+
+   # Evaluated log-posterior values kept with the parameter values as key
+   cache = {}
+   stats = {'evaluations': 0, 'cache_hits': 0, 'time_evaluations': 0.0}
+
+   def log_posterior(xs):
+      xs = [np.array(x, dtype=float) for x in xs]
+      logp = np.full(len(xs), -np.inf)
+      todo = []
+      for i, x in enumerate(xs):
+         if np.any(x < lower) or np.any(x > upper):
+            continue
+         elif x.tobytes() in cache.keys():
+            logp[i] = cache[x.tobytes()]
+            stats['cache_hits'] = stats['cache_hits'] + 1
+         else:
+            todo.append(i)
+      unique = list({xs[i].tobytes(): i for i in todo}.values())
+      tic_eval = time.time()
+      if pool is None:
+         results = [simu_case_try(case(xs[i])) for i in unique]
+      else:
+         results = pool.map(simu_case_try, [case(xs[i]) for i in unique], chunksize=1)
+      stats['time_evaluations'] = stats['time_evaluations'] + time.time() - tic_eval
+      stats['evaluations'] = stats['evaluations'] + len(unique)
+      for i, res in zip(unique, results):
+         cache[xs[i].tobytes()] = -0.5*sum_squares(res)/s2
+      stats['cache_hits'] = stats['cache_hits'] + len(todo) - len(unique)
+      for i in todo:
+         logp[i] = cache[xs[i].tobytes()]
+      return logp
+
+   # Resume from checkpoint or start walkers in a ball around the start values
+   rng = np.random.default_rng(seed)
+   chain, chain_logp, accepted = [], [], 0
+   resumed = False
+   if (checkpoint is not None) and os.path.isfile(checkpoint):
+      saved = np.load(checkpoint)
+      if list(saved['params']) != list(params) or saved['chain'].shape[1] != walkers:
+         print('Error: checkpoint', checkpoint, 'is for other parameters or number of walkers')
+         return None
+      chain, chain_logp = list(saved['chain']), list(saved['logp'])
+      accepted = int(saved['accepted'])
+      rng.bit_generator.state = json.loads(str(saved['rng']))
+      for x, value in zip(saved['cache_x'], saved['cache_logp']):
+         cache[np.array(x, dtype=float).tobytes()] = float(value)
+      resumed = True
+
+   def save_checkpoint():
+      path_tmp = checkpoint + '.tmp'
+      with open(path_tmp, 'wb') as f:
+         np.savez(f, params=np.array(params), chain=np.array(chain), logp=np.array(chain_logp),
+                  accepted=accepted, rng=json.dumps(rng.bit_generator.state),
+                  cache_x=np.array([np.frombuffer(key) for key in cache.keys()]).reshape(-1, n),
+                  cache_logp=np.array(list(cache.values())))
+      os.replace(path_tmp, checkpoint)
+
+   if workers is None: workers = min(walkers//2, os.cpu_count())
+   pool = simu_pool(workers)
+   tic = time.time()
+   try:
+      if resumed:
+         X, logp = np.array(chain[-1]), np.array(chain_logp[-1])
+      else:
+         X = x0*(1 + spread*rng.standard_normal((walkers, n))) + spread*1e-3*rng.standard_normal((walkers, n))
+         X = np.clip(X, lower, upper)
+         logp = log_posterior(X)
+         if not np.any(np.isfinite(logp)):
+            print('Error: no walker has a finite posterior at the start - check parDict and bounds')
+            return None
+
+      half = walkers//2
+      for step in range(len(chain), steps):
+         for first, other in [(slice(0, half), slice(half, walkers)), (slice(half, walkers), slice(0, half))]:
+            z = ((a - 1)*rng.random(half) + 1)**2/a
+            partner = X[other][rng.integers(0, half, half)]
+            proposal = partner + z[:,None]*(X[first] - partner)
+            logp_proposal = log_posterior(proposal)
+            with np.errstate(invalid='ignore'):
+               log_ratio = (n - 1)*np.log(z) + logp_proposal - logp[first]
+            accept = np.log(rng.random(half)) < log_ratio
+            X[first][accept] = proposal[accept]
+            logp[first][accept] = logp_proposal[accept]
+            accepted = accepted + int(np.sum(accept))
+         chain.append(X.copy())
+         chain_logp.append(logp.copy())
+         if (checkpoint is not None) and ((step + 1) % checkpoint_every == 0 or step + 1 == steps):
+            save_checkpoint()
+   finally:
+      simu_pool_release(pool)
+   toc = time.time()
+
+   chain, chain_logp = np.array(chain), np.array(chain_logp)
+   samples = chain[min(burn, len(chain) - 1):].reshape(-1, n)
+   mean = np.mean(samples, axis=0)
+   std = np.std(samples, axis=0)
+   quantiles = np.quantile(samples, [0.025, 0.5, 0.975], axis=0)
+   tau = mcmc_autocorr(chain[min(burn, len(chain) - 1):])
+
+   result = {'parameters': dict(zip(params, [float(value) for value in mean])),
+             'std': dict(zip(params, std)),
+             'quantiles': {key: quantiles[:,k] for k, key in enumerate(params)},
+             'covariance': np.atleast_2d(np.cov(samples.T)),
+             'chain': chain,
+             'logp': chain_logp,
+             'acceptance': accepted/max(len(chain)*walkers, 1),
+             'autocorrelation_time': dict(zip(params, tau)),
+             'walkers': walkers,
+             'steps': len(chain),
+             'evaluations': stats['evaluations'],
+             'cache_hits': stats['cache_hits'],
+             'evaluations_per_second': stats['evaluations']/max(stats['time_evaluations'], 1e-12),
+             'workers': 1 if pool is None else workers,
+             'time': toc - tic}
+
+   if verbose:
+      print()
+      print('Posterior sampling with', walkers, 'walkers and', len(chain), 'steps, of which', burn, 'burn-in')
+      for k, key in enumerate(params):
+         print(' -'+key, ':', np.round(mean[k], 4), '+/-', np.round(std[k], 4),
+               ' 95% interval', np.round(quantiles[0,k], 4), '-', np.round(quantiles[2,k], 4),
+               ' autocorrelation time', np.round(tau[k], 1))
+      print(' -Acceptance fraction:', np.round(result['acceptance'], 3))
+      print(' -Likelihood evaluations:', stats['evaluations'], ' from cache:', stats['cache_hits'])
+      print(' -Runtime:', np.round(toc - tic, 2), 's and', np.round(result['evaluations_per_second'], 1),
+            'evaluations per second with', result['workers'], 'worker processes')
+   return result
+
+# Jacobian structure of the model from ModelStructure in modelDescription.xml of the FMU
+def model_structure(fmu_model=fmu_model):
+   """ Read the dependencies of the state derivatives from the FMU and return a dictionary with
+        'states' - the state names in the order of the state vector
+        'derivatives' - the names of the state derivatives in the same order
+        'pattern' - boolean Jacobian sparsity pattern, row i derivative and column j state
+        'directional_derivatives' - True if the FMU provides analytic directional derivatives """
+   root = ET.fromstring(zipfile.ZipFile(fmu_model, 'r').read('modelDescription.xml'))
+   variables = root.find('ModelVariables').findall('ScalarVariable')
+
+   # Index of variables in modelDescription.xml starts with 1
+   state_index = {}
+   for k, variable in enumerate(variables):
+      real = variable.find('Real')
+      if (real is not None) and (real.get('derivative') is not None):
+         state_index[k+1] = int(real.get('derivative'))
+
+   # The order of the derivatives in ModelStructure gives the order of the state vector
+   unknowns = root.find('ModelStructure').find('Derivatives').findall('Unknown')
+   states = [state_index[int(unknown.get('index'))] for unknown in unknowns]
+   column = {state: j for j, state in enumerate(states)}
+
+   pattern = np.zeros((len(states), len(states)), dtype=bool)
+   for i, unknown in enumerate(unknowns):
+      dependencies = unknown.get('dependencies')
+      if dependencies is None:
+         pattern[i,:] = True
+      else:
+         for index in dependencies.split():
+            if int(index) in column.keys(): pattern[i, column[int(index)]] = True
+
+   model_exchange = root.find('ModelExchange')
+   directional_derivatives = (model_exchange is not None) and \
+                             (model_exchange.get('providesDirectionalDerivative') in ['true', '1'])
+
+   return {'states': [variables[k-1].get('name') for k in states],
+           'derivatives': [variables[int(unknown.get('index'))-1].get('name') for unknown in unknowns],
+           'pattern': pattern,
+           'directional_derivatives': directional_derivatives}
+
+def jacobian_coloring(pattern):
+   """ Group the columns of the Jacobian that do not share any row (greedy graph colouring).
+       All states in a group can be perturbed together and one derivative evaluation gives all columns. """
+   groups = []
+   rows_used = []
+   for j in np.argsort(-pattern.sum(axis=0), kind='stable'):
+      for g in range(len(groups)):
+         if not np.any(rows_used[g] & pattern[:,j]):
+            groups[g].append(j)
+            rows_used[g] = rows_used[g] | pattern[:,j]
+            break
+      else:
+         groups.append([j])
+         rows_used.append(pattern[:,j].copy())
+   return [sorted(int(j) for j in group) for group in groups]
+
+
+# Linearization kernel with the FMU in continuous time mode, no simulation is done
+def linearize_points(times, X, inputs=[], outputs=[], groups=None, rel_step=1e-6, structure=None):
+   """Linearize at the time points in times and states in the rows of X with the parameters in parDict.
+      Jacobian columns in the same group of states are evaluated together, default one group per state.
+      Returns the matrices A, B, C, D with the time point as first index."""
+
+   if structure is None: structure = model_structure()
+   pattern = structure['pattern']
+   n, m, p = len(structure['states']), len(inputs), len(outputs)
+   if groups is None: groups = [[j] for j in range(n)]
+
+   vr = {variable.name: variable.valueReference for variable in model_description.modelVariables}
+   for name in list(inputs) + list(outputs):
+      if name not in vr.keys():
+         print('Error:', name, '- seems not a variable in the model - check the spelling')
+         return None
+   vr_states = [vr[name] for name in structure['states']]
+   vr_derivatives = [vr[name] for name in structure['derivatives']]
+   vr_inputs = [vr[name] for name in inputs]
+   vr_outputs = [vr[name] for name in outputs]
+
+   if fmu_instance is None: simu_worker_init()
+   fmu = fmu_instance
+   fmu.reset()
+   fmpy.simulation.apply_start_values(fmu, model_description, {parLocation[k]:parDict[k] for k in parDict.keys()})
+   fmu.setupExperiment(startTime=float(times[0]))
+   fmu.enterInitializationMode()
+   fmu.exitInitializationMode()
+
+   def event_iteration():
+      while fmu.newDiscreteStates()[0]: pass
+      fmu.enterContinuousTimeMode()
+
+   event_iteration()
+
+   x = np.zeros(n)
+   dx = np.zeros(n)
+   px = x.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+   pdx = dx.ctypes.data_as(ctypes.POINTER(ctypes.c_double))
+
+   def derivatives(x_point):
+      x[:] = x_point
+      fmu.setContinuousStates(px, n)
+      fmu.getDerivatives(pdx, n)
+      return dx.copy()
+
+   def values(x_point):
+      x[:] = x_point
+      fmu.setContinuousStates(px, n)
+      return np.array(fmu.getReal(vr_outputs)) if p > 0 else np.zeros(0)
+
+   def set_inputs(u):
+      # Inputs and tunable parameters are changed in event mode
+      fmu.enterEventMode()
+      fmu.setReal(vr_inputs, list(u))
+      event_iteration()
+
+   A = np.zeros((len(times), n, n))
+   B = np.zeros((len(times), n, m))
+   C = np.zeros((len(times), p, n))
+   D = np.zeros((len(times), p, m))
+   for k, t in enumerate(times):
+      fmu.setTime(float(t))
+      x[:] = X[k]
+      fmu.setContinuousStates(px, n)
+      fmu.enterEventMode()
+      event_iteration()
+
+      if structure['directional_derivatives']:
+         for group in groups:
+            dd = np.array(fmu.getDirectionalDerivative(vr_derivatives, [vr_states[j] for j in group], [1.0]*len(group)))
+            for j in group:
+               A[k, pattern[:,j], j] = dd[pattern[:,j]]
+         for j in range(n):
+            if p > 0: C[k,:,j] = fmu.getDirectionalDerivative(vr_outputs, [vr_states[j]], [1.0])
+         for j in range(m):
+            B[k,:,j] = fmu.getDirectionalDerivative(vr_derivatives, [vr_inputs[j]], [1.0])
+            if p > 0: D[k,:,j] = fmu.getDirectionalDerivative(vr_outputs, [vr_inputs[j]], [1.0])
+         continue
+
+      x0 = np.array(X[k], dtype=float)
+      h = rel_step*np.maximum(np.abs(x0), 1.0)
+      f0 = derivatives(x0)
+      y0 = values(x0)
+      for group in groups:
+         xj = np.array(x0)
+         xj[group] = xj[group] + h[group]
+         f = derivatives(xj)
+         for j in group:
+            A[k, pattern[:,j], j] = (f - f0)[pattern[:,j]]/h[j]
+      if p > 0:
+         for j in range(n):
+            xj = np.array(x0)
+            xj[j] = xj[j] + h[j]
+            C[k,:,j] = (values(xj) - y0)/h[j]
+      if m > 0:
+         u0 = np.array(fmu.getReal(vr_inputs))
+         hu = rel_step*np.maximum(np.abs(u0), 1.0)
+         for j in range(m):
+            uj = np.array(u0)
+            uj[j] = uj[j] + hu[j]
+            set_inputs(uj)
+            B[k,:,j] = (derivatives(x0) - f0)/hu[j]
+            D[k,:,j] = (values(x0) - y0)/hu[j]
+         set_inputs(u0)
+         derivatives(x0)
+
+   fmu.reset()
+   return {'A': A, 'B': B, 'C': C, 'D': D}
+
+# Linearization around operating points
+def linearize(t=None, state=None, inputs=[], outputs=[], trajectory=None, rel_step=1e-6, options=opts_std):
+   """ Linearize the model to dx/dt = A x + B u, y = C x + D u around operating points and return a
+       dictionary with the matrices and the names of the states, inputs and outputs.
+        t          = time point or array of time points, default the final time of the last simu()
+        state      = dictionary of the states at the time point t, e.g. stateDict
+        inputs     = variables or parDict names perturbed for B and D, e.g. ['F_max'], default []
+        outputs    = variables or parDict names for C and D, e.g. ['bioreactor.c[2]'], default []
+        trajectory = simulation result with time and all states, e.g. sim_res
+       With no arguments the linearization is at the state after the last simu(), i.e. stateDict.
+       Otherwise the states at the time points are taken from the trajectory, or from one simulation
+       with parDict, and all time points are linearized in one pass with the FMU set to each state
+       without further simulation. The matrices then have the time point as first index.
+       Directional derivatives are used if the FMU provides them, otherwise finite differences where
+       states that do not share any derivative are perturbed together. Only for FMU-ME. """
+
+   if flag_type not in ['ME', 'me']:
+      print('Error: Linearization only for FMU-ME')
+      return None
+
+   structure = model_structure()
+   states = structure['states']
+   inputs = [parLocation.get(key, key) for key in inputs]
+   outputs = [parLocation.get(key, key) for key in outputs]
+
+   if (t is None) and (state is None): state = stateDict
+   if t is None: t = prevFinalTime
+   times = np.atleast_1d(np.array(t, dtype=float))
+
+   # States at the time points
+   if state is not None:
+      if times.size > 1:
+         print('Error: With state given only one time point')
+         return None
+      for name in states:
+         if name not in state.keys():
+            print('Error:', name, '- state missing in state')
+            return None
+      X = np.array([[state[name] for name in states]], dtype=float)
+   else:
+      if trajectory is None:
+         trajectory = simu_case(parDict.copy(), max(np.max(times), 1e-6), states, options)
+      try:
+         X = np.column_stack([np.interp(times, trajectory['time'], trajectory[name]) for name in states])
+      except (KeyError, ValueError):
+         print('Error: trajectory must have time and all states', states)
+         return None
+
+   order = np.argsort(times, kind='stable')
+   groups = jacobian_coloring(structure['pattern'])
+   res = linearize_points(times[order], X[order], inputs, outputs, groups, rel_step, structure)
+   if res is None: return None
+   for key in ['A', 'B', 'C', 'D']:
+      res[key][order] = res[key].copy()
+      if np.ndim(t) == 0: res[key] = res[key][0]
+
+   res.update({'time': times if np.ndim(t) > 0 else float(times[0]),
+               'x': X if np.ndim(t) > 0 else X[0],
+               'states': states, 'inputs': inputs, 'outputs': outputs,
+               'method': 'directional derivatives' if structure['directional_derivatives'] else 'finite differences'})
+   return res
+
+def benchmark_linearize(t=None, options=opts_std):
+   """ Linearize at the time points t, default ten points over simulationTime, first by linearize() in one
+       pass and then naively by a new simulation to each time point and one state perturbed at a time.
+       Reports the time of both and the largest difference between the A matrices. """
+
+   if flag_type not in ['ME', 'me']:
+      print('Error: Linearization only for FMU-ME')
+      return None
+
+   if t is None: t = np.linspace(simulationTime/10, simulationTime, 10)
+   times = np.atleast_1d(np.array(t, dtype=float))
+   structure = model_structure()
+   states = structure['states']
+
+   tic = time.time()
+   fast = linearize(times, options=options)
+   time_fast = time.time() - tic
+
+   tic = time.time()
+   A_naive = []
+   for t_point in times:
+      res = simu_case(parDict.copy(), t_point, states, options)
+      x = np.array([[res[name][-1] for name in states]])
+      A_naive.append(linearize_points([t_point], x, structure=structure)['A'][0])
+   time_naive = time.time() - tic
+   A_naive = np.array(A_naive)
+
+   difference = np.max(np.abs(fast['A'] - A_naive))/max(np.max(np.abs(A_naive)), 1e-12)
+   print()
+   print('Linearization at', times.size, 'time points with', len(states), 'states')
+   print(' -One pass along the trajectory       :', np.round(time_fast, 3), 's')
+   print(' -New simulation to each time point   :', np.round(time_naive, 3), 's')
+   print(' -Speed-up:', np.round(time_naive/max(time_fast, 1e-12), 1),
+         ' largest relative difference of A:', '{:.1e}'.format(difference))
+   return {'time_fast': time_fast, 'time_naive': time_naive, 'difference': difference,
+           'A': fast['A'], 'A_naive': A_naive}
+
+# Result cache of simulations with simu_case(), shared by the optimizers
+global simu_cache; simu_cache = {}
+global simu_cache_size; simu_cache_size = 1000
+global simu_cache_stats; simu_cache_stats = {'hits': 0, 'misses': 0}
+
+def simu_cache_key(case, split=None):
+   """Key of a case, a dictionary of arguments to simu_case(), from all values that affect the result,
+      and the time split where simu_map_prefix() joined the result from two simulations"""
+   key = (sorted(case['parDictCase'].items()), float(case['simulationTime']), list(case['output']),
+          sorted(dict(case.get('options', opts_std)).items()), float(case.get('start_time', 0)),
+          sorted(case['stateDictCase'].items()) if case.get('stateDictCase') is not None else None,
+          list(case['stop']) if case.get('stop') is not None else None, split)
+   return hashlib.sha256(repr(key).encode()).hexdigest()
+
+def simu_map_cached(cases, pool=None):
+   """Simulate a list of cases as simu_map() but take results from simu_cache when available and store
+      new results there. The oldest results are dropped when the cache has more than simu_cache_size."""
+   keys = [simu_cache_key(case) for case in cases]
+   missing = {}
+   for key, case in zip(keys, cases):
+      if key in simu_cache.keys():
+         simu_cache_stats['hits'] = simu_cache_stats['hits'] + 1
+      elif key not in missing.keys():
+         missing[key] = case
+         simu_cache_stats['misses'] = simu_cache_stats['misses'] + 1
+   results = simu_map(list(missing.values()), pool)
+   simu_cache.update(zip(missing.keys(), results))
+   result = [simu_cache[key] for key in keys]
+   while len(simu_cache) > simu_cache_size:
+      simu_cache.pop(next(iter(simu_cache)))
+   return result
+
+def simu_cache_clear():
+   """Empty the result cache and the results kept by simu()"""
+   simu_cache.clear()
+   simu_cache_stats.update({'hits': 0, 'misses': 0})
+   simu_horizon.clear()
+   simu_horizon_stats.update({'new': 0, 'extended': 0, 'cut': 0})
+
+# Results of simu() from time 0 kept for reuse with another simulationTime
+global simu_horizon; simu_horizon = {}
+global simu_horizon_stats; simu_horizon_stats = {'new': 0, 'extended': 0, 'cut': 0}
+global simu_horizon_active; simu_horizon_active = False
+
+def simu_horizon_use(active=True):
+   """Let simu() in mode 'Initial' reuse results with simu_horizon_result(). Then sim_res is a dictionary
+      of the variables in the diagrams and the states, since the model itself is not simulated. With
+      simu_horizon_use(False) simu() simulates the FMU each time, as it does by default."""
+   global simu_horizon_active
+   simu_horizon_active = active
+
+def simu_horizon_key(parDictCase, output, options):
+   """Key of a simulation from time 0 from all values that affect the result except simulationTime"""
+   key = (sorted(parDictCase.items()), sorted(output), sorted(dict(options).items()))
+   return hashlib.sha256(repr(key).encode()).hexdigest()
+
+def simu_horizon_result(parDictCase, simulationTime, output, options=opts_std):
+   """Simulate from time 0 as simu_case() but reuse an earlier result with the same parameters, output
+      and options. For a shorter simulationTime the earlier result is cut, and for a longer one the
+      simulation continues from its final states, as simu() does in mode 'cont', and the trajectories
+      are joined. The result has the states besides the variables in output."""
+   states = list(stateDict.keys())
+   output = list(dict.fromkeys(states + list(output)))
+   key = simu_horizon_key(parDictCase, output, options)
+   res = simu_horizon.pop(key, None)
+
+   if res is None:
+      res = simu_case(parDictCase, simulationTime, output, options)
+      simu_horizon_stats['new'] = simu_horizon_stats['new'] + 1
+   elif res['time'][-1] < simulationTime - 1e-9*simulationTime:
+      t_end = res['time'][-1]
+      opts = dict(options)
+      opts['ncp'] = max(int(round(options['ncp']*(simulationTime - t_end)/simulationTime)), 1)
+      extension = simu_case(parDictCase, simulationTime - t_end, output, opts, t_end,
+                            {name: res[name][-1] for name in states})
+      res = {name: np.concatenate([res[name], extension[name][1:]]) for name in res.keys()}
+      simu_horizon_stats['extended'] = simu_horizon_stats['extended'] + 1
+   elif res['time'][-1] > simulationTime + 1e-9*simulationTime:
+      simu_horizon[key] = res
+      n = np.searchsorted(res['time'], simulationTime + 1e-9*simulationTime, side='right')
+      cut = {name: value[:n] for name, value in res.items()}
+      if cut['time'][-1] < simulationTime - 1e-9*simulationTime:
+         cut = {name: np.append(value, np.interp(simulationTime, res['time'], res[name])) for name, value in cut.items()}
+      simu_horizon_stats['cut'] = simu_horizon_stats['cut'] + 1
+      return cut
+
+   # The most recent result last and the oldest dropped first
+   simu_horizon[key] = res
+   while len(simu_horizon) > simu_cache_size:
+      simu_horizon.pop(next(iter(simu_horizon)))
+   return res
+
+# Bayesian optimization of parameters, e.g. the feed profile
+def bayes_opt(params, bounds, objective='bioreactor.m[1]', simulationTime=simulationTime, output=None, q=4,
+              init=None, max_simulations=60, workers=None, options=opts_std, seed=None, verbose=True):
+   """ Maximize an objective over the parameters in the list params, e.g. ['mu_feed', 't_start', 'F_start',
+       'F_max'], with a Gaussian-process surrogate of the objective.
+        bounds          = dictionary of (lower, upper) for each parameter
+        objective       = variable whose final value is maximized, or a function of the simulation result
+                          that returns the value to maximize, then with the variables it needs in output
+        q               = number of candidates proposed in each round and simulated in parallel
+        init            = number of simulations in the initial Latin hypercube design, default 2*len(params)+2
+        max_simulations = budget of new simulations
+       The candidates of a round are chosen one by one by expected improvement, each time with the
+       surrogate updated with its predicted value. All simulations go through the result cache simu_cache.
+       The result is a dictionary with the best parameters and all evaluations, and parDict is updated
+       with the best parameters. """
+
+   try:
+      from scipy.optimize import minimize
+      from scipy.stats import norm
+      from scipy.linalg import cho_factor, cho_solve
+   except ImportError:
+      print('Error: bayes_opt() needs scipy')
+      return None
+
+   for key in params:
+      if key not in parDict.keys():
+         print('Error:', key, '- seems not an accessible parameter - check the spelling')
+         return None
+      if key not in bounds.keys():
+         print('Error:', key, '- has no bounds')
+         return None
+   if isinstance(objective, str):
+      output = [objective]
+      objective_value = lambda res: res[objective][-1]
+   else:
+      if output is None:
+         print('Error: give output with the variables that the objective function needs')
+         return None
+      objective_value = objective
+
+   d = len(params)
+   lower = np.array([bounds[key][0] for key in params], dtype=float)
+   upper = np.array([bounds[key][1] for key in params], dtype=float)
+   rng = np.random.default_rng(seed)
+   if init is None: init = 2*d + 2
+
+   def case(u):
+      parDictCase = parDict.copy()
+      parDictCase.update(dict(zip(params, [float(value) for value in lower + u*(upper - lower)])))
+      return {'parDictCase': parDictCase, 'simulationTime': simulationTime, 'output': output,
+              'options': options}
+
+   stats = {'simulations': 0}
+
+   def evaluate(U):
+      misses = simu_cache_stats['misses']
+      results = simu_map_cached([case(u) for u in U], pool)
+      stats['simulations'] = stats['simulations'] + simu_cache_stats['misses'] - misses
+      return np.array([objective_value(res) for res in results], dtype=float)
+
+   # Gaussian process with Matern 5/2 kernel and one length scale per parameter, on the unit cube
+   def kernel(A, B, length, sf2):
+      r = np.sqrt(np.sum(((A[:,None,:] - B[None,:,:])/length)**2, axis=2))
+      return sf2*(1 + np.sqrt(5)*r + 5/3*r**2)*np.exp(-np.sqrt(5)*r)
+
+   def gp_fit(U, y):
+      def nll(theta):
+         length, sf2, sn2 = np.exp(theta[:d]), np.exp(theta[d]), np.exp(theta[d+1])
+         K = kernel(U, U, length, sf2) + (sn2 + 1e-8)*np.eye(len(y))
+         try:
+            c = cho_factor(K, lower=True)
+         except np.linalg.LinAlgError:
+            return 1e10
+         return 0.5*np.dot(y, cho_solve(c, y)) + np.sum(np.log(np.diag(c[0])))
+      limits = [(np.log(0.02), np.log(5.0))]*d + [(np.log(0.05), np.log(20.0)), (np.log(1e-6), np.log(0.1))]
+      best = None
+      for start in [np.log([0.3]*d + [1.0, 1e-3]), np.log(list(rng.uniform(0.05, 1.0, d)) + [1.0, 1e-4])]:
+         res = minimize(nll, start, method='L-BFGS-B', bounds=limits)
+         if (best is None) or (res.fun < best.fun): best = res
+      length, sf2, sn2 = np.exp(best.x[:d]), np.exp(best.x[d]), np.exp(best.x[d+1])
+      c = cho_factor(kernel(U, U, length, sf2) + (sn2 + 1e-8)*np.eye(len(y)), lower=True)
+      return {'U': U, 'length': length, 'sf2': sf2, 'sn2': sn2, 'c': c, 'alpha': cho_solve(c, y)}
+
+   def gp_predict(gp, V):
+      k = kernel(V, gp['U'], gp['length'], gp['sf2'])
+      mean = k @ gp['alpha']
+      var = gp['sf2'] - np.sum(k*cho_solve(gp['c'], k.T).T, axis=1)
+      return mean, np.sqrt(np.maximum(var, 1e-12))
+
+   def expected_improvement(gp, V, best):
+      mean, s = gp_predict(gp, V)
+      z = (mean - best)/s
+      return (mean - best)*norm.cdf(z) + s*norm.pdf(z)
+
+   if workers is None: workers = min(q, os.cpu_count())
+   pool = simu_pool(workers)
+   tic = time.time()
+   try:
+      # Initial design with the present parDict values included
+      u0 = np.clip((np.array([parDict[key] for key in params], dtype=float) - lower)/(upper - lower), 0, 1)
+      n = max(init - 1, 1)
+      U = np.vstack([u0, (np.argsort(rng.random((n, d)), axis=0) + rng.random((n, d)))/n])
+      y = evaluate(U)
+      rounds = 0
+
+      while stats['simulations'] < max_simulations:
+         finite = np.isfinite(y)
+         mean_y, std_y = np.mean(y[finite]), max(np.std(y[finite]), 1e-12)
+         U_fit, y_fit = U[finite], (y[finite] - mean_y)/std_y
+         gp = gp_fit(U_fit, y_fit)
+
+         # Batch of q candidates where each is believed to give its predicted value
+         batch = []
+         for j in range(min(q, max_simulations - stats['simulations'])):
+            best_y = np.max(y_fit)
+            u_best = U_fit[np.argmax(y_fit)]
+            V = np.vstack([rng.random((2000, d)),
+                           np.clip(u_best + 0.05*rng.standard_normal((500, d)), 0, 1)])
+            ei = expected_improvement(gp, V, best_y)
+            u_new = V[np.argmax(ei)]
+            res = minimize(lambda u: -expected_improvement(gp, u.reshape(1, -1), best_y)[0], u_new,
+                           method='L-BFGS-B', bounds=[(0, 1)]*d)
+            if -res.fun > np.max(ei): u_new = res.x
+            batch.append(u_new)
+            U_fit = np.vstack([U_fit, u_new])
+            y_fit = np.append(y_fit, gp_predict(gp, u_new.reshape(1, -1))[0])
+            gp = gp_fit(U_fit, y_fit) if j < q - 1 else gp
+
+         simulations = stats['simulations']
+         y_batch = evaluate(np.array(batch))
+         U = np.vstack([U, batch])
+         y = np.append(y, y_batch)
+         rounds = rounds + 1
+         if stats['simulations'] == simulations: break
+   finally:
+      simu_pool_release(pool)
+   toc = time.time()
+
+   k_best = np.nanargmax(y)
+   X = lower + U*(upper - lower)
+   estimates = dict(zip(params, [float(value) for value in X[k_best]]))
+   par(**estimates)
+
+   result = {'parameters': estimates,
+             'objective': float(y[k_best]),
+             'X': X,
+             'y': y,
+             'rounds': rounds,
+             'simulations': stats['simulations'],
+             'workers': 1 if pool is None else workers,
+             'time': toc - tic}
+
+   if verbose:
+      print()
+      print('Bayesian optimization with', rounds, 'rounds of', q, 'candidates')
+      for key in params:
+         print(' -'+key, ':', np.round(estimates[key], 4))
+      print(' -Objective:', np.round(result['objective'], 4), ' at start:', np.round(y[0], 4))
+      print(' -Simulations:', stats['simulations'], ' results in cache:', len(simu_cache))
+      print(' -Runtime:', np.round(toc - tic, 2), 's with', result['workers'], 'worker processes')
+   return result
+
+def benchmark_bayes_opt(params, bounds, objective='bioreactor.m[1]', simulationTime=simulationTime, levels=5,
+                        q=4, max_simulations=50, workers=None, options=opts_std, seed=None):
+   """ Maximize the objective over params within bounds first by grid search with levels values of each
+       parameter, levels**len(params) simulations, and then by bayes_opt() with max_simulations, and report
+       the best objective and the simulations and time used by each. The grid search does not use the
+       result cache, which is emptied before bayes_opt(). parDict is left as it was. """
+
+   for key in params:
+      if key not in parDict.keys():
+         print('Error:', key, '- seems not an accessible parameter - check the spelling')
+         return None
+      if key not in bounds.keys():
+         print('Error:', key, '- has no bounds')
+         return None
+
+   parDictStart = parDict.copy()
+   grid = np.array(np.meshgrid(*[np.linspace(bounds[key][0], bounds[key][1], levels) for key in params],
+                               indexing='ij')).reshape(len(params), -1).T
+   cases = []
+   for x in grid:
+      parDictCase = parDict.copy()
+      parDictCase.update(dict(zip(params, [float(value) for value in x])))
+      cases.append({'parDictCase': parDictCase, 'simulationTime': simulationTime, 'output': [objective],
+                    'options': options})
+
+   if workers is None: workers = min(q, os.cpu_count())
+   pool = simu_pool(workers)
+   tic = time.time()
+   try:
+      y_grid = np.array([res[objective][-1] for res in simu_map(cases, pool)], dtype=float)
+   finally:
+      simu_pool_release(pool)
+   time_grid = time.time() - tic
+   k_best = np.nanargmax(y_grid)
+
+   simu_cache_clear()
+   try:
+      res = bayes_opt(params, bounds, objective, simulationTime, q=q, max_simulations=max_simulations,
+                      workers=workers, options=options, seed=seed, verbose=False)
+   finally:
+      parDict.clear()
+      parDict.update(parDictStart)
+   if res is None: return None
+
+   # Reached when within a thousandth of the spread of the objective over the grid
+   reached = res['objective'] >= y_grid[k_best] - 1e-3*max(np.ptp(y_grid[np.isfinite(y_grid)]), 1e-12)
+
+   print()
+   print('Optimization of', objective, 'over', params)
+   print(' -Grid search :', len(grid), 'simulations ', np.round(time_grid, 2), 's  best',
+         np.round(y_grid[k_best], 4))
+   print(' -bayes_opt() :', res['simulations'], 'simulations ', np.round(res['time'], 2), 's  best',
+         np.round(res['objective'], 4), ' grid optimum reached:', reached)
+   return {'grid': {'parameters': dict(zip(params, [float(value) for value in grid[k_best]])),
+                    'objective': float(y_grid[k_best]), 'simulations': len(grid), 'time': time_grid},
+           'bayes_opt': {'parameters': res['parameters'], 'objective': res['objective'],
+                         'simulations': res['simulations'], 'time': res['time']},
+           'reached': bool(reached)}
+
+# Multi-objective optimization of the dosage scheme
+def dosage_objectives(res):
+   """Volumetric productivity [g/(L h)], biomass yield on substrate [g/g] and feed used [L] at the end
+      of a simulation result with the variables in dosage_output"""
+   X_formed = res['bioreactor.m[1]'][-1] - res['bioreactor.m[1]'][0]
+   feed = res['feedtank.V'][0] - res['feedtank.V'][-1]
+   S_used = res['bioreactor.m[2]'][0] + feed*res['feedtank.c_in[2]'][0] - res['bioreactor.m[2]'][-1]
+   return {'productivity': X_formed/(res['bioreactor.V'][-1]*(res['time'][-1] - res['time'][0])),
+           'yield': X_formed/max(S_used, 1e-12),
+           'feed': feed}
+
+global dosage_output
+dosage_output = ['bioreactor.m[1]', 'bioreactor.m[2]', 'bioreactor.V', 'feedtank.V', 'feedtank.c_in[2]']
+
+def pareto_rank(F):
+   """Non-dominated sorting of the rows of F, all objectives minimized. Returns the front number of each
+      row, 0 for the non-dominated, and the crowding distance within its front."""
+   F = np.asarray(F, dtype=float)
+   dominates = np.all(F[:,None,:] <= F[None,:,:], axis=2) & np.any(F[:,None,:] < F[None,:,:], axis=2)
+   rank = np.full(len(F), -1)
+   remaining = np.ones(len(F), dtype=bool)
+   front = 0
+   while np.any(remaining):
+      index = np.where(remaining)[0]
+      current = index[~np.any(dominates[np.ix_(index, index)], axis=0)]
+      rank[current] = front
+      remaining[current] = False
+      front = front + 1
+
+   crowding = np.zeros(len(F))
+   for front in np.unique(rank):
+      members = np.where(rank == front)[0]
+      if len(members) <= 2:
+         crowding[members] = np.inf
+         continue
+      if not np.all(np.isfinite(F[members])):
+         continue
+      order = np.argsort(F[members], axis=0)
+      sorted_F = np.take_along_axis(F[members], order, axis=0)
+      span = np.maximum(sorted_F[-1] - sorted_F[0], 1e-12)
+      distance = np.zeros((len(members), F.shape[1]))
+      distance[1:-1] = (sorted_F[2:] - sorted_F[:-2])/span
+      distance[0] = distance[-1] = np.inf
+      np.put_along_axis(distance, order, distance.copy(), axis=0)
+      crowding[members] = np.sum(distance, axis=1)
+   return rank, crowding
+
+def nsga2(params, bounds, objectives={'productivity': 'max', 'yield': 'max', 'feed': 'min'},
+          evaluate=dosage_objectives, output=dosage_output, simulationTime=simulationTime, population=24,
+          generations=20, workers=None, options=opts_std, checkpoint=None, seed=None, verbose=True):
+   """ Multi-objective optimization with NSGA-II of the parameters in the list params, e.g. the dosage
+       scheme ['mu_feed', 't_start', 'F_start', 'F_max'].
+        bounds      = dictionary of (lower, upper) for each parameter
+        objectives  = dictionary of the objectives to use from evaluate() and 'max' or 'min' for each
+        evaluate    = function of a simulation result that returns a dictionary of objective values,
+                      default dosage_objectives(), that needs the variables in output
+        population  = number of parameter sets in each generation
+        generations = number of generations, including generations of a resumed checkpoint
+        checkpoint  = npz-file where population and front are saved after each generation and resumed from
+       Each generation is simulated in parallel by the worker processes through the result cache simu_cache.
+       The result is a dictionary with the parameters and objectives of the Pareto front of all evaluated
+       parameter sets, e.g. for plt.plot(r['objectives']['yield'], r['objectives']['productivity'], 'o'). """
+
+   for key in params:
+      if key not in parDict.keys():
+         print('Error:', key, '- seems not an accessible parameter - check the spelling')
+         return None
+      if key not in bounds.keys():
+         print('Error:', key, '- has no bounds')
+         return None
+   names = list(objectives.keys())
+   sign = np.array([-1.0 if objectives[name] == 'max' else 1.0 for name in names])
+
+   d = len(params)
+   lower = np.array([bounds[key][0] for key in params], dtype=float)
+   upper = np.array([bounds[key][1] for key in params], dtype=float)
+   population = population + population % 2
+   rng = np.random.default_rng(seed)
+
+   def case(x):
+      parDictCase = parDict.copy()
+      parDictCase.update(dict(zip(params, [float(value) for value in x])))
+      return {'parDictCase': parDictCase, 'simulationTime': simulationTime, 'output': output,
+              'options': options}
+
+   stats = {'simulations': 0}
+
+   def objective_values(X):
+      misses = simu_cache_stats['misses']
+      results = simu_map_cached([case(x) for x in X], pool)
+      stats['simulations'] = stats['simulations'] + simu_cache_stats['misses'] - misses
+      values = [evaluate(res) for res in results]
+      return np.array([[values[k][name] for name in names] for k in range(len(X))])*sign
+
+   # Simulated binary crossover and polynomial mutation in the box of the bounds
+   def offspring(X, rank, crowding):
+      def tournament():
+         i, j = rng.integers(0, len(X), 2)
+         better = (rank[i] < rank[j]) or ((rank[i] == rank[j]) and (crowding[i] > crowding[j]))
+         return X[i] if better else X[j]
+      children = []
+      eta_c, eta_m = 15.0, 20.0
+      while len(children) < population:
+         p1, p2 = tournament(), tournament()
+         u = rng.random(d)
+         beta = np.where(u <= 0.5, (2*u)**(1/(eta_c + 1)), (1/(2*(1 - u)))**(1/(eta_c + 1)))
+         cross = rng.random(d) < 0.5
+         c1 = np.where(cross, 0.5*((1 + beta)*p1 + (1 - beta)*p2), p1)
+         c2 = np.where(cross, 0.5*((1 - beta)*p1 + (1 + beta)*p2), p2)
+         for c in [c1, c2]:
+            u = rng.random(d)
+            delta = np.where(u < 0.5, (2*u)**(1/(eta_m + 1)) - 1, 1 - (2*(1 - u))**(1/(eta_m + 1)))
+            mutate = rng.random(d) < 1/d
+            children.append(np.clip(c + mutate*delta*(upper - lower), lower, upper))
+      return np.array(children[:population])
+
+   # Resume from checkpoint or start with a Latin hypercube design
+   generation = 0
+   archive_X, archive_F = np.zeros((0, d)), np.zeros((0, len(names)))
+   if (checkpoint is not None) and os.path.isfile(checkpoint):
+      saved = np.load(checkpoint)
+      if list(saved['params']) != list(params) or list(saved['objectives']) != names:
+         print('Error: checkpoint', checkpoint, 'is for other parameters or objectives')
+         return None
+      X, F = saved['X'], saved['F']
+      archive_X, archive_F = saved['front_X'], saved['front_F']
+      generation = int(saved['generation'])
+      rng.bit_generator.state = json.loads(str(saved['rng']))
+
+   def save_checkpoint():
+      path_tmp = checkpoint + '.tmp'
+      with open(path_tmp, 'wb') as f:
+         np.savez(f, params=np.array(params), objectives=np.array(names), X=X, F=F, front_X=archive_X,
+                  front_F=archive_F, generation=generation, rng=json.dumps(rng.bit_generator.state))
+      os.replace(path_tmp, checkpoint)
+
+   def update_archive(X_new, F_new):
+      X_all, F_all = np.vstack([archive_X, X_new]), np.vstack([archive_F, F_new])
+      finite = np.all(np.isfinite(F_all), axis=1)
+      X_all, F_all = X_all[finite], F_all[finite]
+      unique = np.sort(np.unique(X_all, axis=0, return_index=True)[1])
+      X_all, F_all = X_all[unique], F_all[unique]
+      first = pareto_rank(F_all)[0] == 0
+      return X_all[first], F_all[first]
+
+   if workers is None: workers = min(population, os.cpu_count())
+   pool = simu_pool(workers)
+   tic = time.time()
+   try:
+      if generation == 0:
+         X = lower + (np.argsort(rng.random((population, d)), axis=0) + rng.random((population, d)))/population*(upper - lower)
+         F = objective_values(X)
+         archive_X, archive_F = update_archive(X, F)
+         generation = 1
+         if checkpoint is not None: save_checkpoint()
+
+      while generation < generations:
+         F_rank = np.where(np.isfinite(F), F, np.inf)
+         rank, crowding = pareto_rank(F_rank)
+         children = offspring(X, rank, crowding)
+         F_children = objective_values(children)
+         archive_X, archive_F = update_archive(children, F_children)
+
+         # Survivors by front and then crowding distance
+         X_all, F_all = np.vstack([X, children]), np.vstack([F, F_children])
+         rank, crowding = pareto_rank(np.where(np.isfinite(F_all), F_all, np.inf))
+         survivors = np.lexsort((-crowding, rank))[:population]
+         X, F = X_all[survivors], F_all[survivors]
+         generation = generation + 1
+         if checkpoint is not None: save_checkpoint()
+   finally:
+      simu_pool_release(pool)
+   toc = time.time()
+
+   order = np.argsort(archive_F[:,0])
+   front_X, front_F = archive_X[order], archive_F[order]*sign
+   result = {'parameters': {key: front_X[:,k] for k, key in enumerate(params)},
+             'objectives': {name: front_F[:,k] for k, name in enumerate(names)},
+             'X': front_X,
+             'F': front_F,
+             'population': X,
+             'generations': generation,
+             'simulations': stats['simulations'],
+             'workers': 1 if pool is None else workers,
+             'time': toc - tic}
+
+   if verbose:
+      print()
+      print('NSGA-II with population', population, 'after', generation, 'generations')
+      print(' -Pareto front:', len(front_X), 'parameter sets')
+      for k, name in enumerate(names):
+         print(' -'+name, '(' + objectives[name] + ') :', np.round(np.min(front_F[:,k]), 4), '-',
+               np.round(np.max(front_F[:,k]), 4))
+      print(' -Simulations:', stats['simulations'])
+      print(' -Runtime:', np.round(toc - tic, 2), 's with', result['workers'], 'worker processes')
+   return result
+
+# Simulation of sweep cases that share the simulation up to where their parameters start to act
+def simu_map_prefix(cases, pool=None):
+   """Simulate a list of cases as simu_map_cached(), where the cases start at time 0 from parDictCase.
+      Cases that differ only in parameters of parActsAfter are grouped, and each group is simulated
+      once up to the earliest time any of these parameters acts. Each case then continues from the
+      states there, as simu() does in mode 'cont', and the trajectories are joined. The results are
+      kept in simu_cache with the time of the split in the key, since their time points differ from
+      those of a simulation from the start. Returns the results and the simulated time saved compared
+      to simulating all cases from the start."""
+
+   # Groups of cases equal in all but the parameters of parActsAfter
+   groups = {}
+   for k, case in enumerate(cases):
+      common = [(name, value) for name, value in sorted(case['parDictCase'].items()) if name not in parActsAfter.keys()]
+      group = repr((common, float(case['simulationTime']), list(case['output']), sorted(dict(case['options']).items())))
+      groups.setdefault(group, []).append(k)
+
+   # Time of the split of each case, None for a case simulated from the start
+   split = [None]*len(cases)
+   for group, members in groups.items():
+      parDicts = [cases[k]['parDictCase'] for k in members]
+      varied = [name for name in parActsAfter.keys() if len(set([parDictCase[name] for parDictCase in parDicts])) > 1]
+      t_prefix = min([parDictCase[parActsAfter[name]] for parDictCase in parDicts for name in varied] + [np.inf])
+      if 0 < t_prefix < cases[members[0]]['simulationTime']:
+         for k in members: split[k] = float(t_prefix)
+
+   keys = [simu_cache_key(case, split[k]) for k, case in enumerate(cases)]
+   missing = {}
+   for k, key in enumerate(keys):
+      if key in simu_cache.keys():
+         simu_cache_stats['hits'] = simu_cache_stats['hits'] + 1
+      elif key not in missing.keys():
+         missing[key] = k
+         simu_cache_stats['misses'] = simu_cache_stats['misses'] + 1
+
+   def scaled(options, fraction):
+      opts = dict(options)
+      opts['ncp'] = max(int(round(options['ncp']*fraction)), 1)
+      return opts
+
+   # First the prefix of each group with missing cases and the cases simulated from the start
+   states = list(stateDict.keys())
+   first, direct, prefixes, saved = [], {}, {}, 0.0
+   for key, k in missing.items():
+      case = cases[k]
+      if split[k] is None:
+         direct[key] = len(first)
+         first.append(case)
+         continue
+      t_prefix = split[k]
+      group = [group for group, members in groups.items() if k in members][0]
+      if group not in prefixes.keys():
+         prefixes[group] = (len(first), [])
+         first.append({'parDictCase': case['parDictCase'], 'simulationTime': t_prefix,
+                       'output': list(dict.fromkeys(states + list(case['output']))),
+                       'options': scaled(case['options'], t_prefix/case['simulationTime'])})
+      else:
+         saved = saved + t_prefix
+      prefixes[group][1].append(key)
+   results_first = simu_map(first, pool)
+
+   # Then the cases of the groups from the states at the split
+   results = {key: results_first[index] for key, index in direct.items()}
+   branches, branch_keys = [], []
+   for group, (index, members) in prefixes.items():
+      prefix = results_first[index]
+      stateDictCase = {name: prefix[name][-1] for name in states}
+      for key in members:
+         case = cases[missing[key]]
+         t_prefix = split[missing[key]]
+         branches.append({'parDictCase': case['parDictCase'], 'simulationTime': case['simulationTime'] - t_prefix,
+                          'output': list(case['output']),
+                          'options': scaled(case['options'], 1 - t_prefix/case['simulationTime']),
+                          'start_time': t_prefix, 'stateDictCase': stateDictCase})
+         branch_keys.append((key, prefix))
+   for (key, prefix), branch in zip(branch_keys, simu_map(branches, pool)):
+      results[key] = {name: np.concatenate([prefix[name], branch[name][1:]]) for name in branch.keys()}
+
+   simu_cache.update(results)
+   result = [simu_cache[key] for key in keys]
+   while len(simu_cache) > simu_cache_size:
+      simu_cache.pop(next(iter(simu_cache)))
+   return result, saved
+
+
+# Parameter sweep
+def sweep_design(bounds, n, seed=None):
+   """Latin hypercube design of n parameter sets within bounds, a dictionary of (lower, upper) for each
+      parameter, as a list of dictionaries for sweep()"""
+   rng = np.random.default_rng(seed)
+   keys = list(bounds.keys())
+   lower = np.array([bounds[key][0] for key in keys], dtype=float)
+   upper = np.array([bounds[key][1] for key in keys], dtype=float)
+   U = (np.argsort(rng.random((n, len(keys))), axis=0) + rng.random((n, len(keys))))/n
+   return [dict(zip(keys, [float(value) for value in lower + u*(upper - lower)])) for u in U]
+
+def sweep(values, simulationTime=simulationTime, output=None, workers=None, options=opts_std, engine='fmu',
+          prefix=True, stop=None, verbose=True):
+   """ Simulate for many parameter sets with the other parameters from parDict.
+        values = dictionary with a list of values for each parameter, all combinations are simulated,
+                 or a list of dictionaries with parameter values, e.g. from sweep_design()
+        output = variables to store, default the states
+        engine = 'fmu' or 'numpy' for ensemble_simu() as a low-fidelity engine for screening
+        prefix = True to simulate the start that cases share before their parameters act only once
+        stop   = conditions that end a simulation early, e.g. ['feedtank.V <= 0'], see simu_case()
+       The simulations are done in parallel by the worker processes through the result cache simu_cache.
+       The result is a dictionary with the parameter values and a list of simulation results, and with
+       stop the condition that ended each simulation in 'stop' and its time in 'stop_time', else None
+       and nan. """
+
+   if isinstance(values, dict):
+      keys = list(values.keys())
+      grid = np.meshgrid(*[np.atleast_1d(values[key]) for key in keys], indexing='ij')
+      values = [dict(zip(keys, [float(g.flat[k]) for g in grid])) for k in range(grid[0].size)]
+   keys = list(values[0].keys()) if len(values) > 0 else []
+   for key in keys:
+      if key not in parDict.keys():
+         print('Error:', key, '- seems not an accessible parameter - check the spelling')
+         return None
+   if output is None: output = list(stateDict.keys())
+
+   cases = []
+   for value in values:
+      parDictCase = parDict.copy()
+      parDictCase.update(value)
+      cases.append({'parDictCase': parDictCase, 'simulationTime': simulationTime, 'output': list(output),
+                    'options': options})
+      if stop is not None: cases[-1]['stop'] = [stop] if isinstance(stop, str) else list(stop)
+
+   if (engine == 'numpy') and (stop is not None):
+      print('Error: stop conditions only with engine fmu')
+      return None
+   elif engine == 'numpy':
+      tic = time.time()
+      results = ensemble_simu([case['parDictCase'] for case in cases], simulationTime, output, options['ncp'])
+      if results is None: return None
+      toc = time.time()
+      return {'parameters': {key: np.array([value[key] for value in values]) for key in keys},
+              'results': results, 'output': list(output), 'simulationTime': simulationTime,
+              'base': parDict.copy(), 'simulations': 0, 'workers': 1, 'time': toc - tic}
+   elif engine != 'fmu':
+      print('Error: engine must be fmu or numpy')
+      return None
+
+   if workers is None: workers = min(len(cases), os.cpu_count())
+   pool = simu_pool(workers)
+   misses = simu_cache_stats['misses']
+   tic = time.time()
+   try:
+      if prefix and (stop is None):
+         results, saved = simu_map_prefix(cases, pool)
+      else:
+         results, saved = simu_map_cached(cases, pool), 0.0
+   finally:
+      simu_pool_release(pool)
+   toc = time.time()
+   if stop is not None: results, records = zip(*[simu_stop_split(res) for res in results])
+
+   result = {'parameters': {key: np.array([value[key] for value in values]) for key in keys},
+             'results': list(results),
+             'output': list(output),
+             'simulationTime': simulationTime,
+             'base': parDict.copy(),
+             'simulations': simu_cache_stats['misses'] - misses,
+             'saved': saved,
+             'stopped': sum([record['stop'] is not None for record in records]) if stop is not None else 0,
+             'workers': 1 if pool is None else workers,
+             'time': toc - tic}
+   if stop is not None:
+      result['stop'] = [record['stop'] for record in records]
+      result['stop_time'] = np.array([np.nan if record['stop_time'] is None else record['stop_time']
+                                      for record in records])
+   if verbose:
+      print('Sweep of', len(cases), 'parameter sets with', result['simulations'], 'new simulations in',
+            np.round(toc - tic, 2), 's')
+      if saved > 0:
+         print(' -Shared start simulated once saved', np.round(saved, 2), 'of',
+               np.round(result['simulations']*simulationTime, 2), 'time units of simulation')
+      if result['stopped'] > 0:
+         print(' -Stopped early:', result['stopped'], 'of', len(cases), 'simulations')
+   return result
+
+# Surrogate model of trajectories trained from sweep results
+global simu_surrogate; simu_surrogate = None
+
+def surrogate_train(sweep_result, params=None, output=None, points=201, validation=0.2, tol=1e-4,
+                    kernel='thin_plate_spline', seed=None, verbose=True):
+   """ Train a surrogate model of the trajectories of the variables in output as functions of the
+       parameters params, by default those of the sweep. The trajectories are sampled at points time
+       points and compressed to principal components, and the component weights are interpolated over
+       the parameters with radial basis functions. The fraction validation of the sweep is first left
+       out to estimate the error, reported relative to the range of each variable, and then the
+       surrogate is trained with all. The surrogate is a dictionary for surrogate_eval() and surrogate_use(). """
+
+   try:
+      from scipy.interpolate import RBFInterpolator
+   except ImportError:
+      print('Error: surrogate_train() needs scipy')
+      return None
+
+   if params is None: params = list(sweep_result['parameters'].keys())
+   if output is None: output = sweep_result['output']
+   for name in output:
+      if name not in sweep_result['output']:
+         print('Error:', name, '- not in the output of the sweep')
+         return None
+
+   X = np.column_stack([sweep_result['parameters'][key] for key in params])
+   lower, upper = np.min(X, axis=0), np.max(X, axis=0)
+   U = (X - lower)/np.where(upper > lower, upper - lower, 1.0)
+   t = np.linspace(0, sweep_result['simulationTime'], points)
+   Y = np.array([np.concatenate([np.interp(t, res['time'], res[name]) for name in output])
+                 for res in sweep_result['results']])
+   Y = Y.reshape(len(X), len(output), points)
+   scale = np.maximum(np.max(Y, axis=(0, 2)) - np.min(Y, axis=(0, 2)), 1e-12)
+   Y = (Y/scale[None,:,None]).reshape(len(X), -1)
+
+   def train(rows):
+      mean = np.mean(Y[rows], axis=0)
+      _, s, Vt = np.linalg.svd(Y[rows] - mean, full_matrices=False)
+      energy = np.cumsum(s**2)/max(np.sum(s**2), 1e-300)
+      components = int(np.searchsorted(energy, 1 - tol) + 1)
+      basis = Vt[:components]
+      rbf = RBFInterpolator(U[rows], (Y[rows] - mean) @ basis.T, kernel=kernel)
+      return {'mean': mean, 'basis': basis, 'rbf': rbf}
+
+   def predict(model, V):
+      return model['mean'] + model['rbf'](V) @ model['basis']
+
+   # Validation error with a part of the sweep left out
+   rng = np.random.default_rng(seed)
+   order = rng.permutation(len(X))
+   n_val = int(round(validation*len(X)))
+   error = {}
+   if n_val > 0 and len(X) - n_val > len(params) + 1:
+      model = train(order[n_val:])
+      E = (predict(model, U[order[:n_val]]) - Y[order[:n_val]]).reshape(n_val, len(output), points)
+      error = {name: float(np.sqrt(np.mean(E[:,i,:]**2))) for i, name in enumerate(output)}
+
+   model = train(np.arange(len(X)))
+   surrogate = {'params': list(params), 'output': list(output), 'time': t, 'lower': lower, 'upper': upper,
+                'scale': scale, 'mean': model['mean'], 'basis': model['basis'], 'rbf': model['rbf'],
+                'simulationTime': sweep_result['simulationTime'], 'base': sweep_result['base'],
+                'validation_error': error, 'samples': len(X)}
+
+   if verbose:
+      print()
+      print('Surrogate of', len(output), 'trajectories from', len(X), 'simulations with',
+            len(model['basis']), 'principal components')
+      for name in error.keys():
+         print(' -'+name, ': validation error', '{:.2e}'.format(error[name]), 'of range')
+   return surrogate
+
+def surrogate_eval(surrogate, X):
+   """Trajectories from the surrogate for the parameter sets in the rows of X, in the order of
+      surrogate['params'], or a dictionary of arrays of each parameter. Returns a dictionary with
+      time and an array with one trajectory per parameter set for each variable."""
+   if isinstance(X, dict): X = np.column_stack([np.atleast_1d(X[key]) for key in surrogate['params']])
+   X = np.atleast_2d(np.array(X, dtype=float))
+   span = np.where(surrogate['upper'] > surrogate['lower'], surrogate['upper'] - surrogate['lower'], 1.0)
+   W = surrogate['rbf']((X - surrogate['lower'])/span)
+   Y = (surrogate['mean'] + W @ surrogate['basis']).reshape(len(X), len(surrogate['output']), -1)
+   result = {'time': surrogate['time']}
+   for i, name in enumerate(surrogate['output']):
+      result[name] = Y[:,i,:]*surrogate['scale'][i]
+   return result
+
+def surrogate_use(surrogate=None):
+   """Let simu() in mode 'Initial' use the surrogate when parDict is within its trained domain and
+      otherwise simulate the FMU as usual. Without argument simu() always simulates the FMU."""
+   global simu_surrogate
+   simu_surrogate = surrogate
+
+def surrogate_result(simulationTime, diagrams, parDictCase=None):
+   """Result for simu() from the surrogate in use, or None if the FMU is to be simulated since
+      parDictCase, default parDict, or simulationTime is outside what the surrogate is trained for or
+      variables are missing"""
+   if parDictCase is None: parDictCase = parDict
+   surrogate = simu_surrogate
+   if surrogate is None: return None
+   if simulationTime != surrogate['simulationTime']: return None
+   names = set(re.findall(r"sim_res\['([^']+)'\]", ' '.join(diagrams))) | set(stateDict.keys())
+   names.discard('time')
+   if not names <= set(surrogate['output']): return None
+   for key in parDictCase.keys():
+      if (key not in surrogate['params']) and (parDictCase[key] != surrogate['base'].get(key)): return None
+   x = np.array([parDictCase[key] for key in surrogate['params']], dtype=float)
+   if np.any(x < surrogate['lower']) or np.any(x > surrogate['upper']): return None
+   res = surrogate_eval(surrogate, x)
+   return {name: (value if name == 'time' else value[0]) for name, value in res.items()}
+
+# Native NumPy ensemble integrator of the model as a low-fidelity engine
+global ensemble_output
+ensemble_output = ['bioreactor.V', 'bioreactor.m[1]', 'bioreactor.m[2]', 'feedtank.V', 'bioreactor.c[1]',
+                   'bioreactor.c[2]', 'bioreactor.culture.q[1]', 'bioreactor.culture.q[2]', 'bioreactor.inlet[1].F']
+
+def ensemble_rhs(t, y, p):
+   """Right hand side of the model for all members, with states V, m[1], m[2] and feedtank.V in the
+      columns of y, and dictionary p with arrays of the parameters with the names in parDict"""
+   V, m1, m2 = y[:,0], y[:,1], y[:,2]
+   c2 = m2/V
+   qS = p['qSmax']*c2/(p['Ks'] + c2)
+   F = np.where(t < p['t_start'], p['F_0'],
+                np.minimum(p['F_start']*np.exp(p['mu_feed']*(t - p['t_start'])), p['F_max']))
+   return np.column_stack([F, p['Y']*qS*m1, -qS*m1 + p['feedtank_S_in']*F, -F]), qS, F
+
+def ensemble_simu(parDicts, simulationTime=simulationTime, output=ensemble_output, ncp=500, rtol=1e-6,
+                  atol=1e-9, max_steps=100000):
+   """ Integrate the model for all parameter sets in the list parDicts at the same time, with the keys
+       of parDict, by an embedded Runge-Kutta 5(4) method of Dormand-Prince. Each member has its own
+       step size from its error estimate, and all members advance in one state array of shape
+       (members, states) per step. Steps end exactly at the output time points and at t_start where
+       the exponential feed starts. Returns a list of results as simu_case() with the variables in output. """
+
+   for name in output:
+      if name not in ensemble_output:
+         print('Error:', name, '- not available from ensemble_simu(), use any of', ensemble_output)
+         return None
+
+   n = len(parDicts)
+   keys = ['V_0', 'VX_0', 'VS_0', 'Y', 'qSmax', 'Ks', 'feedtank_S_in', 'feedtank_V_0', 'mu_feed', 't_start',
+           'F_start', 'F_max']
+   p = {key: np.array([parDictCase[key] for parDictCase in parDicts], dtype=float) for key in keys}
+   p['F_0'] = np.array([parDictCase.get('F_0', 0.0) for parDictCase in parDicts], dtype=float)
+
+   # Dormand-Prince coefficients
+   c = np.array([0, 1/5, 3/10, 4/5, 8/9, 1, 1])
+   a = [[], [1/5], [3/40, 9/40], [44/45, -56/15, 32/9], [19372/6561, -25360/2187, 64448/6561, -212/729],
+        [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656],
+        [35/384, 0, 500/1113, 125/192, -2187/6784, 11/84]]
+   b = np.array([35/384, 0, 500/1113, 125/192, -2187/6784, 11/84, 0])
+   e = b - np.array([5179/57600, 0, 7571/16695, 393/640, -92097/339200, 187/2100, 1/40])
+
+   t_out = np.linspace(0, simulationTime, ncp+1)
+   Y = np.zeros((n, ncp+1, 4))
+   y = np.column_stack([p['V_0'], p['VX_0'], p['VS_0'], p['feedtank_V_0']])
+   Y[:,0,:] = y
+   t = np.zeros(n)
+   k_out = np.ones(n, dtype=int)
+   h = np.full(n, min(1e-3, simulationTime/ncp))
+   active = np.ones(n, dtype=bool) if ncp > 0 else np.zeros(n, dtype=bool)
+   steps = 0
+
+   while np.any(active) and steps < max_steps:
+      i = np.where(active)[0]
+      pi = {key: value[i] for key, value in p.items()}
+      ti, yi = t[i], y[i]
+
+      # Steps end at the next output time point or at t_start
+      t_next = t_out[k_out[i]]
+      t_next = np.where(ti < pi['t_start'], np.minimum(t_next, pi['t_start']), t_next)
+      hi = np.minimum(h[i], t_next - ti)
+      hits = hi >= t_next - ti
+
+      K = [ensemble_rhs(ti, yi, pi)[0]]
+      for s in range(1, 7):
+         ys = yi + hi[:,None]*sum([a[s][j]*K[j] for j in range(s)])
+         K.append(ensemble_rhs(ti + c[s]*hi, ys, pi)[0])
+      y_new = yi + hi[:,None]*sum([b[j]*K[j] for j in range(7)])
+      error = hi[:,None]*sum([e[j]*K[j] for j in range(7)])
+      scale = atol + rtol*np.maximum(np.abs(yi), np.abs(y_new))
+      norm = np.sqrt(np.mean((error/scale)**2, axis=1))
+      accept = norm <= 1
+
+      # Accepted steps that reach an output time point or t_start land exactly there
+      ia = i[accept]
+      t[ia] = np.where(hits[accept], t_next[accept], ti[accept] + hi[accept])
+      y[ia] = y_new[accept]
+      out = ia[np.isclose(t[ia], t_out[k_out[ia]], rtol=0, atol=1e-12*max(simulationTime, 1))]
+      Y[out, k_out[out], :] = y[out]
+      k_out[out] = k_out[out] + 1
+      active[out[k_out[out] > ncp]] = False
+
+      factor = np.clip(0.9*np.maximum(norm, 1e-10)**(-1/5), 0.2, 5.0)
+      h[i] = np.where(accept & hits, np.maximum(h[i], hi*factor), hi*factor)
+      steps = steps + 1
+
+   if np.any(active):
+      print('Warning: ensemble_simu() reached max_steps for', np.sum(active), 'members')
+
+   # Algebraic variables from the states at the output time points
+   results = []
+   for m in range(n):
+      pm = {key: value[m:m+1].repeat(ncp+1) for key, value in p.items()}
+      _, qS, F = ensemble_rhs(t_out, Y[m], pm)
+      V, m1, m2 = Y[m,:,0], Y[m,:,1], Y[m,:,2]
+      variables = {'bioreactor.V': V, 'bioreactor.m[1]': m1, 'bioreactor.m[2]': m2, 'feedtank.V': Y[m,:,3],
+                   'bioreactor.c[1]': m1/V, 'bioreactor.c[2]': m2/V, 'bioreactor.culture.q[1]': pm['Y']*qS,
+                   'bioreactor.culture.q[2]': -qS, 'bioreactor.inlet[1].F': F}
+      result = {'time': t_out}
+      result.update({name: variables[name] for name in output})
+      results.append(result)
+   return results
+
+def ensemble_validate(n=20, bounds=None, simulationTime=simulationTime, seed=None, options=opts_std):
+   """Compare ensemble_simu() with the FMU for n random parameter sets within bounds, default +-50% of
+      parDict for the culture and feed parameters, and report the largest deviation of each state
+      relative to its range together with the time of both"""
+   if bounds is None:
+      bounds = {key: (0.5*parDict[key], 1.5*parDict[key]) for key in ['Y', 'qSmax', 'Ks', 'mu_feed', 'F_start']}
+   values = sweep_design(bounds, n, seed)
+   parDicts = []
+   for value in values:
+      parDictCase = parDict.copy()
+      parDictCase.update(value)
+      parDicts.append(parDictCase)
+   states = ['bioreactor.V', 'bioreactor.m[1]', 'bioreactor.m[2]', 'feedtank.V']
+
+   tic = time.time()
+   fmu_results = [simu_case(parDictCase, simulationTime, states, options) for parDictCase in parDicts]
+   time_fmu = time.time() - tic
+   tic = time.time()
+   ensemble_results = ensemble_simu(parDicts, simulationTime, states)
+   time_ensemble = time.time() - tic
+
+   deviation = {}
+   for name in states:
+      span = max(np.max([np.ptp(res[name]) for res in fmu_results]), 1e-12)
+      deviation[name] = max([np.max(np.abs(np.interp(res_e['time'], res_f['time'], res_f[name]) - res_e[name]))
+                             for res_f, res_e in zip(fmu_results, ensemble_results)])/span
+
+   print()
+   print('Validation of ensemble_simu() against the FMU for', n, 'parameter sets')
+   for name in states:
+      print(' -'+name, ': largest deviation', '{:.1e}'.format(deviation[name]), 'of range')
+   print(' -Time FMU:', np.round(time_fmu, 3), 's  ensemble:', np.round(time_ensemble, 3), 's')
+   return {'deviation': deviation, 'time_fmu': time_fmu, 'time_ensemble': time_ensemble}
+
+# Parallel-in-time simulation with Parareal
+def parareal_coarse(tolerance=1e-2, options=opts_std):
+   """Options for the coarse propagator of parareal(), with one output point for each time window and
+      the relative tolerance of CVode, by default loose so that the coarse propagator is cheap and
+      differs from the fine one. Euler is not used since it is unstable with steps as long as a window."""
+   return {'ncp': 1, 'relative_tolerance': tolerance}
+
+def parareal(simulationTime=simulationTime, windows=None, output=None, coarse_options=None, coarse_tolerance=1e-2,
+             tol=1e-4, max_iterations=None, workers=None, options=opts_std, verbose=True, parDictCase=None):
+   """ Simulate with parDictCase, default parDict, from time 0 by Parareal, where the horizon is split
+       in time windows that are simulated at the same time by the worker processes.
+        windows          = number of time windows, default the number of cores
+        output           = variables to store, default the states
+        coarse_options   = options of the serial coarse propagator, default parareal_coarse()
+        coarse_tolerance = relative tolerance of the default coarse propagator
+        tol              = largest change of the states at the window boundaries, relative to their size
+                           over the horizon, for convergence
+       Each iteration simulates the windows not yet converged with options in parallel, from the states
+       at the window starts as simu() does in mode 'cont', and then corrects the states at the window
+       starts serially with the coarse propagator. After k iterations the first k windows are exact.
+       The result is a dictionary with time and the variables in output, as from simu_case(), together
+       with the iterations, the time used and the largest deviation of the coarse from the fine
+       propagator at the window ends in the first iteration, relative to the size of the states. """
+
+   if windows is None: windows = os.cpu_count()
+   if max_iterations is None: max_iterations = windows
+   states = list(stateDict.keys())
+   if output is None: output = states
+   output_all = list(dict.fromkeys(states + list(output)))
+
+   T = np.linspace(0, simulationTime, windows+1)
+   if coarse_options is None: coarse_options = parareal_coarse(coarse_tolerance, options)
+   fine_options = dict(options)
+   fine_options['ncp'] = max(int(round(options['ncp']/windows)), 1)
+   parDictCase = (parDict if parDictCase is None else parDictCase).copy()
+
+   def case(n, x, opts, out):
+      return {'parDictCase': parDictCase, 'simulationTime': T[n+1] - T[n], 'output': out, 'options': opts,
+              'start_time': T[n], 'stateDictCase': None if n == 0 else dict(zip(states, x))}
+
+   def final(res):
+      return np.array([res[name][-1] for name in states], dtype=float)
+
+   stats = {'coarse': 0, 'fine': 0}
+
+   def coarse(n, x):
+      stats['coarse'] = stats['coarse'] + 1
+      return final(simu_case(**case(n, x, coarse_options, states)))
+
+   if workers is None: workers = min(windows, os.cpu_count())
+   pool = simu_pool(workers)
+   tic = time.time()
+   try:
+      # Start of each window from the coarse propagator, U[n] state at T[n] and G[n] coarse end of window n
+      U = np.full((windows+1, len(states)), np.nan)
+      G = np.full((windows, len(states)), np.nan)
+      for n in range(windows):
+         G[n] = coarse(n, U[n])
+         U[n+1] = G[n]
+
+      results = [None]*windows
+      iterations = 0
+      converged = False
+      history = []
+      while (iterations < max_iterations) and not converged:
+         active = list(range(iterations, windows))
+         fine = simu_map([case(n, U[n], fine_options, output_all) for n in active], pool)
+         stats['fine'] = stats['fine'] + len(active)
+         for n, res in zip(active, fine): results[n] = res
+         F = {n: final(res) for n, res in zip(active, fine)}
+         iterations = iterations + 1
+         if iterations == 1:
+            scale = np.maximum(np.max(np.abs(U[1:]), axis=0), 1e-12)
+            deviation = float(np.max([np.abs(F[n] - G[n])/scale for n in active]))
+
+         # Serial correction where the first window not yet converged is exact
+         U_new = U.copy()
+         U_new[active[0]+1] = F[active[0]]
+         for n in active[1:]:
+            g = coarse(n, U_new[n])
+            U_new[n+1] = g + F[n] - G[n]
+            G[n] = g
+         scale = np.maximum(np.nanmax(np.abs(U_new[1:]), axis=0), 1e-12)
+         change = float(np.max(np.abs(U_new[1:] - U[1:])/scale))
+         history.append(change)
+         U = U_new
+         converged = (change <= tol) or (iterations == windows)
+   finally:
+      simu_pool_release(pool)
+   toc = time.time()
+
+   # Trajectory from the fine simulation of each window, with the start point of windows after the first left out
+   result = {name: np.concatenate([results[0][name]] + [res[name][1:] for res in results[1:]])
+             for name in ['time'] + output_all}
+   result.update({'iterations': iterations, 'converged': converged, 'change': history, 'windows': windows,
+                  'coarse_deviation': deviation,
+                  'coarse_simulations': stats['coarse'], 'fine_simulations': stats['fine'],
+                  'workers': 1 if pool is None else workers, 'runtime': toc - tic})
+
+   if verbose:
+      print()
+      print('Parareal with', windows, 'windows and', result['workers'], 'worker processes')
+      print(' -Iterations:', iterations, ' converged:', converged, ' last change:', '{:.1e}'.format(history[-1]))
+      print(' -Simulations: coarse', stats['coarse'], ' fine', stats['fine'],
+            ' deviation of coarse from fine:', '{:.1e}'.format(deviation))
+      print(' -Runtime:', np.round(toc - tic, 3), 's')
+   return result
+
+def benchmark_parareal(simulationTime=simulationTime, windows=None, coarse_tolerance=1e-2, tol=1e-4, workers=None,
+                       options=opts_std):
+   """ Simulate with parDict over simulationTime, e.g. 20 h, first serially in one simulation and then
+       by parareal(), and report the iterations to convergence, the speed-up and the largest deviation
+       of the final states relative to their range. """
+
+   states = list(stateDict.keys())
+   tic = time.time()
+   serial = simu_case(parDict.copy(), simulationTime, states, options)
+   time_serial = time.time() - tic
+
+   res = parareal(simulationTime, windows, states, None, coarse_tolerance, tol, None, workers, options, verbose=False)
+   deviation = max([abs(res[name][-1] - serial[name][-1])/max(np.ptp(serial[name]), 1e-12) for name in states])
+
+   print()
+   print('Parareal over', simulationTime, 'with', res['windows'], 'windows and', res['workers'], 'worker processes')
+   print(' -Iterations to convergence:', res['iterations'], ' converged:', res['converged'])
+   print(' -Deviation of coarse from fine propagator:', '{:.1e}'.format(res['coarse_deviation']))
+   print(' -Serial simulation :', np.round(time_serial, 3), 's')
+   print(' -Parareal          :', np.round(res['runtime'], 3), 's')
+   print(' -Speed-up:', np.round(time_serial/max(res['runtime'], 1e-12), 2),
+         ' largest deviation of the final states:', '{:.1e}'.format(deviation), 'of range')
+   return {'time_serial': time_serial, 'time_parareal': res['runtime'], 'iterations': res['iterations'],
+           'converged': res['converged'], 'deviation': deviation, 'coarse_deviation': res['coarse_deviation']}
+
+# Checkpoints after each simulation with simu() for rollback()
+global simu_checkpoints; simu_checkpoints = []
+global simu_checkpoints_size; simu_checkpoints_size = 20
+
+def simu_checkpoint():
+   """Keep stateDict, parDict, prevFinalTime, sim_res and start_values after a simulation with simu(). The
+      oldest checkpoint is dropped when there are more than simu_checkpoints_size."""
+   simu_checkpoints.append({'stateDict': dict(stateDict), 'parDict': dict(parDict), 'prevFinalTime': prevFinalTime,
+                            'sim_res': sim_res, 'start_values': dict(start_values)})
+   while len(simu_checkpoints) > simu_checkpoints_size:
+      simu_checkpoints.pop(0)
+
+def rollback(n=1):
+   """Undo the last n simulations with simu() and return to stateDict, parDict, prevFinalTime, sim_res
+      and start_values after the simulation before them, so that simu() in mode 'cont' continues from
+      there, e.g. after a mistaken par(), and disp() and describe() show that simulation. Nothing is
+      simulated again. The diagrams are not changed."""
+   global prevFinalTime, sim_res, start_values
+   if not 1 <= n < len(simu_checkpoints):
+      print('Error: Can roll back 1 to', len(simu_checkpoints) - 1, 'simulations with the checkpoints kept')
+      return
+   del simu_checkpoints[len(simu_checkpoints) - n:]
+   checkpoint = simu_checkpoints[-1]
+   stateDict.update(checkpoint['stateDict'])
+   parDict.clear()
+   parDict.update(checkpoint['parDict'])
+   prevFinalTime = checkpoint['prevFinalTime']
+   sim_res = checkpoint['sim_res']
+   start_values = dict(checkpoint['start_values'])
+   print('Rolled back to time', np.round(prevFinalTime, 3))
+
+# Checkpoints on disk to continue a simulation later or on another computer
+def fmu_hash(path=fmu_model):
+   """SHA-256 of the FMU file"""
+   with open(path, 'rb') as f:
+      return hashlib.sha256(f.read()).hexdigest()
+
+def save_checkpoint(path, tail=10):
+   """Save stateDict, parDict and prevFinalTime after the last simu() in one compressed npz-file, together
+      with the hash of the FMU and the last tail points of sim_res. After load_checkpoint() the simulation
+      continues from stateDict with simu() in mode 'cont'."""
+   if prevFinalTime == 0:
+      print('Error: Checkpoint is saved after a simulation with simu()')
+      return
+   if isinstance(sim_res, dict):
+      names = list(sim_res.keys())
+   elif hasattr(sim_res, 'dtype'):
+      names = list(sim_res.dtype.names)
+   else:
+      names = ['time'] + list(stateDict.keys())
+   tail_values = np.array([np.asarray(sim_res[name])[-tail:] for name in names])
+
+   path_tmp = path + '.tmp'
+   with open(path_tmp, 'wb') as f:
+      np.savez_compressed(f, fmu=fmu_hash(), parDict=json.dumps(parDict, default=float),
+                          stateDict=json.dumps(stateDict, default=float), prevFinalTime=prevFinalTime,
+                          tail_names=np.array(names), tail=tail_values)
+   os.replace(path_tmp, path)
+
+def load_checkpoint(path):
+   """Load a checkpoint from save_checkpoint() for the same FMU and set stateDict, parDict, prevFinalTime
+      and sim_res with the tail of the result. Continue with simu() in mode 'cont'."""
+   global prevFinalTime, sim_res, start_values
+   with np.load(path) as saved:
+      if str(saved['fmu']) != fmu_hash():
+         print('Error: Checkpoint', path, 'is for another FMU')
+         return
+      parDict.clear()
+      parDict.update(json.loads(str(saved['parDict'])))
+      stateDict.update(json.loads(str(saved['stateDict'])))
+      prevFinalTime = float(saved['prevFinalTime'])
+      sim_res = {str(name): saved['tail'][k] for k, name in enumerate(saved['tail_names'])}
+      start_values = {parLocation[k]:parDict[k] for k in parDict.keys()}
+   simu_checkpoint()
+   print('Checkpoint loaded at time', np.round(prevFinalTime, 3))
+
+# Simulation sessions with state of their own
+class FMUSession:
+   """ Simulation session with its own parDict, stateDict, prevFinalTime, sim_res, start_values, diagrams
+       and line types, and par(), init(), simu(), disp() and describe(). The functions of the same name
+       are those of the default session fmu_session, that keeps its state in the module globals.
+       Each simulation runs on an FMU instance checked out for it, so many sessions can simulate at
+       the same time from threads or asyncio tasks without interfering. Calls on the same session
+       wait for each other.
+        base     = parameters to start from, default a copy of parDict
+        diagrams = list of plot commands as from newplot() with sim_res and linetype, default none """
+
+   def __init__(self, base=None, diagrams=None, lines=['-','--',':','-.']):
+      self.parDict = dict(parDict if base is None else base)
+      self.stateDict = dict(stateDict)
+      self.prevFinalTime = 0
+      self.sim_res = None
+      self.sim_stop = None
+      self.start_values = {}
+      self.diagrams = [] if diagrams is None else list(diagrams)
+      self.linecycler = cycle(lines)
+      self.lock = threading.RLock()
+
+   def par(self, *x, **x_kwarg):
+      """Set parameter values if available in parDict of the session"""
+      x_kwarg.update(*x)
+      simu_refine_cancel(self)
+      with self.lock:
+         for key in x_kwarg.keys():
+            if key in self.parDict.keys():
+               self.parDict[key] = x_kwarg[key]
+            else:
+               print('Error:', key, '- seems not an accessible parameter - check the spelling')
+         parErrors = [requirement for requirement in parCheck if not(eval(requirement, globals(), {'parDict': self.parDict}))]
+      if not parErrors == []:
+         print('Error - the following requirements do not hold:')
+         for item in parErrors: print(item)
+
+   def init(self, *x, **x_kwarg):
+      """Set initial values of the session, the name should contain string '_0' to be accepted"""
+      x_kwarg.update(*x)
+      x_init = {}
+      for key in x_kwarg.keys():
+         if '_0' in key:
+            x_init[key] = x_kwarg[key]
+         else:
+            print('Error:', key, '- seems not an initial value, use par() instead - check the spelling')
+      self.par(x_init)
+
+   def output(self, diagrams=None):
+      """Variables stored by simu(): the states, the key variables and the variables of the diagrams,
+         default those of the session, that are in the model"""
+      if diagrams is None: diagrams = self.diagrams
+      output = re.findall(r"sim_res\['([^']+)'\]", ' '.join(diagrams)) + list(self.stateDict.keys()) + key_variables
+      names = set([variable.name for variable in model_description.modelVariables])
+      return [name for name in dict.fromkeys(output) if name in names]
+
+   def mode_start(self, mode):
+      """Start time and states of a simulation in mode 'Initial' or 'cont', or None with an error"""
+      if mode in ['Initial', 'initial', 'init']:
+         return 0, None
+      elif mode in ['Continued', 'continued', 'cont']:
+         if self.prevFinalTime == 0:
+            print("Error: Simulation is first done with default mode = init'")
+            return None
+         return self.prevFinalTime, dict(self.stateDict)
+      else:
+         print('Error: Simulation mode not correct')
+         return None
+
+   def simu(self, simulationTime=simulationTime, mode='Initial', options=opts_std, step_finished=None,
+            diagrams=None, stop=None):
+      """ Simulate in mode 'Initial', 'cont', 'progressive' or 'parareal' and plot the diagrams, default
+          those of the session. options may be the name of a profile from solver_tune(), and stop has
+          conditions that end the simulation early, see simu_stop(). step_finished is passed to
+          simu_case(), and the simulation stops when it returns False. Returns sim_res of the session. """
+
+      # Solver profile by name from solver_tune()
+      if isinstance(options, str): options = solver_profile(options)
+      if options is None: return None
+      if diagrams is None: diagrams = self.diagrams
+
+      # Coarse run at once refined in the background, a background run stopped or waited for, and
+      # simulation with stop conditions
+      if mode in ['Progressive', 'progressive']:
+         return simu_progressive(simulationTime, 'Initial', options, diagrams=diagrams, session=self)
+      if mode in ['Continued', 'continued', 'cont']:
+         simu_refine_wait(self)
+      else:
+         simu_refine_cancel(self)
+      if stop is not None: return simu_stop(simulationTime, mode, options, stop, diagrams, session=self)
+
+      with self.lock:
+         parDictCase = dict(self.parDict)
+         output = self.output(diagrams)
+
+         if mode in ['Parareal', 'parareal']:
+            # Simulate in parallel time windows
+            sim_res = parareal(simulationTime, output=output, options=options, verbose=False,
+                               parDictCase=parDictCase)
+         else:
+            start = self.mode_start(mode)
+            if start is None: return None
+            start_time, stateDictCase = start
+
+            # By the surrogate model if activated by surrogate_use() and parDict within its domain, or
+            # reuse of a simulation with the same parameters and another simulationTime if activated by
+            # simu_horizon_use()
+            sim_res = None
+            if (start_time == 0) and (step_finished is None):
+               sim_res = surrogate_result(simulationTime, diagrams, parDictCase)
+               if (sim_res is None) and simu_horizon_active:
+                  sim_res = simu_horizon_result(parDictCase, simulationTime, output, options)
+            if sim_res is None:
+               sim_res = simu_case(parDictCase, simulationTime, output, options, start_time, stateDictCase,
+                                   step_finished)
+
+         # Plot, keep the result with the final states, and a checkpoint for rollback()
+         self.result_use(sim_res, diagrams)
+         self.checkpoint()
+         return sim_res
+
+   def result_use(self, res, diagrams=None, linetype=None):
+      """Plot res with the diagrams, default those of the session, and keep it as sim_res, with start_values,
+         stateDict and prevFinalTime. Returns the plotted lines and the line type."""
+      if diagrams is None: diagrams = self.diagrams
+      with self.lock:
+         self.sim_res = res
+         self.sim_stop = None
+         self.start_values = {parLocation[k]:self.parDict[k] for k in self.parDict.keys()}
+         if linetype is None: linetype = next(self.linecycler)
+         lines = []
+         for command in diagrams:
+            plotted = eval(command, globals(), {'sim_res': res, 't': res['time'], 'linetype': linetype})
+            lines = lines + (list(plotted) if isinstance(plotted, list) else [plotted])
+         for key in self.stateDict.keys(): self.stateDict[key] = float(res[key][-1])
+         self.prevFinalTime = float(res['time'][-1])
+      return lines, linetype
+
+   def checkpoint(self):
+      """Checkpoint for rollback() after a simulation, kept only for the default session"""
+      pass
+
+   def disp(self, name='', decimals=3, mode='short'):
+      """Display initial values and parameters of the session as disp()"""
+      for key in self.parDict.keys():
+         if (name in key) or (name in parLocation[key]):
+            value = self.parDict[key]
+            if not isinstance(value, (bool, np.bool_)): value = np.round(value, decimals)
+            if mode in ['long', 'location']:
+               print(parLocation[key], ':', key, ':', value)
+            else:
+               print(key, ':', value)
+
+   def describe(self, name, decimals=3):
+      """Describe as describe() with the parameters and the last simulation of the session"""
+      location = parLocation[name] if name in parLocation.keys() else name
+      if name in self.parDict.keys():
+         value = self.parDict[name]
+      elif isinstance(self.sim_res, dict) and (location in self.sim_res.keys()) and (location != 'time'):
+         value = self.sim_res[location][-1]
+      else:
+         describe_model(name, decimals)
+         return
+      description = model_get_variable_description(location)
+      unit = model_get_variable_unit(location) or ''
+      if isinstance(value, (bool, np.bool_)):
+         print(description, ':', value)
+      elif unit == '':
+         print(description, ':', np.round(value, decimals))
+      else:
+         print(description, ':', np.round(value, decimals), '[',unit,']')
+
+class FMUSessionDefault(FMUSession):
+   """ Default session fmu_session of par(), init(), simu(), disp() and describe(). Its parDict, stateDict
+       and diagrams are the module globals, and prevFinalTime, sim_res, start_values and the line types
+       are kept in the module globals of the same name, that the other functions use. """
+
+   prevFinalTime = property(lambda self: prevFinalTime, lambda self, value: globals().update(prevFinalTime=value))
+   sim_res = property(lambda self: globals().get('sim_res'), lambda self, value: globals().update(sim_res=value))
+   sim_stop = property(lambda self: globals().get('sim_stop'), lambda self, value: globals().update(sim_stop=value))
+   start_values = property(lambda self: globals().get('start_values', {}),
+                           lambda self, value: globals().update(start_values=value))
+   linecycler = property(lambda self: linecycler, lambda self, value: globals().update(linecycler=value))
+
+   def __init__(self):
+      self.parDict = parDict
+      self.stateDict = stateDict
+      self.diagrams = diagrams
+      self.lock = threading.RLock()
+
+   def checkpoint(self):
+      """Checkpoint for rollback() after a simulation"""
+      simu_checkpoint()
+
+global fmu_session; fmu_session = FMUSessionDefault()
+
+# Simulation with asyncio that does not block the event loop of a notebook or a service
+global simu_async_executor; simu_async_executor = None
+global simu_async_workers; simu_async_workers = None
+global simu_async_queue; simu_async_queue = None
+global simu_async_limits; simu_async_limits = {}
+
+def simu_async_setup(workers=None, queue=None):
+   """Thread pool with workers threads, default os.cpu_count(), that runs the simulations of simu_async()
+      and sweep_async(), and the number of simulations queued or running at most, default 4*workers.
+      Further requests wait until there is a place in the queue."""
+   global simu_async_executor, simu_async_workers, simu_async_queue, simu_async_limits
+   if simu_async_executor is not None: simu_async_executor.shutdown(wait=False)
+   simu_async_workers = os.cpu_count() if workers is None else workers
+   simu_async_queue = 4*simu_async_workers if queue is None else queue
+   simu_async_executor = concurrent.futures.ThreadPoolExecutor(simu_async_workers)
+   simu_async_limits = {}
+   simu_worker_init(simu_async_workers)
+
+async def simu_async_run(function, cancel):
+   """Run function in the thread pool when there is a place in the queue. If the awaiting task is
+      cancelled the event cancel is set and the place is kept until the simulation has stopped."""
+   if simu_async_executor is None: simu_async_setup()
+   loop = asyncio.get_running_loop()
+   if loop not in simu_async_limits.keys(): simu_async_limits[loop] = asyncio.Semaphore(simu_async_queue)
+   async with simu_async_limits[loop]:
+      future = loop.run_in_executor(simu_async_executor, function)
+      try:
+         return await asyncio.shield(future)
+      except asyncio.CancelledError:
+         cancel.set()
+         await asyncio.wait([future])
+         raise
+
+def simu_async_step(cancel, progress, loop, start_time, simulationTime):
+   """Function for step_finished of simu_case() that stops the simulation when cancel is set and calls
+      progress in the thread of the event loop with the time and the fraction done, at most every percent"""
+   reported = [-1]
+   def step_finished(time, chunk):
+      fraction = min(max((time - start_time)/simulationTime, 0.0), 1.0)
+      if (progress is not None) and (int(100*fraction) > reported[0]):
+         reported[0] = int(100*fraction)
+         loop.call_soon_threadsafe(progress, {'time': time, 'fraction': fraction})
+      return not cancel.is_set()
+   return step_finished
+
+async def simu_async(simulationTime=simulationTime, mode='Initial', options=opts_std, session=None, progress=None):
+   """ Simulate as simu() without blocking the event loop, e.g. await simu_async(20) in a notebook.
+       The FMU runs in the thread pool of simu_async_setup(), and when done the diagrams are plotted and
+       sim_res, stateDict and prevFinalTime are updated here as by simu(). With session, an FMUSession,
+       that session is simulated instead and no global is touched, so many can run at the same time.
+       If the task is cancelled the simulation stops after the current output interval and nothing
+       is updated. progress is called with a dictionary of time and fraction done. Returns sim_res. """
+
+   loop = asyncio.get_running_loop()
+   cancel = threading.Event()
+
+   if session is not None:
+      start_time = 0 if mode in ['Initial', 'initial', 'init'] else session.prevFinalTime
+      step_finished = simu_async_step(cancel, progress, loop, start_time, simulationTime)
+      return await simu_async_run(lambda: session.simu(simulationTime, mode, options, step_finished), cancel)
+
+   start = simu_mode_start(mode)
+   if start is None: return None
+   start_time, stateDictCase = start
+
+   parDictCase = dict(parDict)
+   output = fmu_session.output(diagrams)
+   step_finished = simu_async_step(cancel, progress, loop, start_time, simulationTime)
+   res = await simu_async_run(lambda: simu_case(parDictCase, simulationTime, output, options, start_time,
+                                                stateDictCase, step_finished), cancel)
+
+   # Plot and store as simu() does, here in the thread of the event loop
+   simu_result_use(res, diagrams)
+   simu_checkpoint()
+   return res
+
+async def sweep_async(values, simulationTime=simulationTime, output=None, options=opts_std, progress=None,
+                      stop=None):
+   """ Sweep as sweep() without blocking the event loop. The parameter sets are simulated in the thread
+       pool of simu_async_setup() and queued there with the requests of other tasks. If the task is
+       cancelled all simulations stop after the current output interval. progress is called with a
+       dictionary of the number of simulations done and in total. stop has conditions that end
+       a simulation early as in sweep(). Returns the result as sweep(). """
+
+   if isinstance(values, dict):
+      keys = list(values.keys())
+      grid = np.meshgrid(*[np.atleast_1d(values[key]) for key in keys], indexing='ij')
+      values = [dict(zip(keys, [float(g.flat[k]) for g in grid])) for k in range(grid[0].size)]
+   keys = list(values[0].keys()) if len(values) > 0 else []
+   for key in keys:
+      if key not in parDict.keys():
+         print('Error:', key, '- seems not an accessible parameter - check the spelling')
+         return None
+   if output is None: output = list(stateDict.keys())
+
+   cancel = threading.Event()
+   cancelled = lambda time, chunk: not cancel.is_set()
+   done = [0]
+
+   async def simulate(value):
+      parDictCase = parDict.copy()
+      parDictCase.update(value)
+      res = await simu_async_run(lambda: simu_case(parDictCase, simulationTime, list(output), options,
+                                                   step_finished=cancelled, stop=stop), cancel)
+      done[0] = done[0] + 1
+      if progress is not None: progress({'done': done[0], 'total': len(values)})
+      return res
+
+   tic = time.time()
+   try:
+      results = await asyncio.gather(*[simulate(value) for value in values])
+   except asyncio.CancelledError:
+      cancel.set()
+      raise
+   toc = time.time()
+   if stop is not None: results, records = zip(*[simu_stop_split(res) for res in results])
+
+   result = {'parameters': {key: np.array([value[key] for value in values]) for key in keys},
+             'results': list(results),
+             'output': list(output),
+             'simulationTime': simulationTime,
+             'base': parDict.copy(),
+             'simulations': len(values),
+             'workers': simu_async_workers,
+             'time': toc - tic}
+   if stop is not None:
+      result['stop'] = [record['stop'] for record in records]
+      result['stop_time'] = np.array([np.nan if record['stop_time'] is None else record['stop_time']
+                                      for record in records])
+   return result
+
+# Streaming of results during long simulations
+def simu_stream(simulationTime=simulationTime, mode='Initial', output=None, k=10, options=opts_std, ahead=2):
+   """ Generator that simulates as simu() and yields the results while the simulation runs, as a
+       dictionary with time and the variables in output, default the states, every k output intervals.
+       Samples handed on are not kept, so memory stays constant for long simulations, and the simulation
+       waits when ahead chunks are not yet taken. When the generator is finished stateDict and
+       prevFinalTime are updated as by simu(), and sim_res is the last chunk. If it is closed before,
+       the simulation is stopped and nothing is updated. E.g.
+        for chunk in simu_stream(100, output=['bioreactor.c[1]']): print(chunk['time'][-1]) """
+
+   global sim_res, prevFinalTime
+
+   start = simu_mode_start(mode)
+   if start is None: return
+   start_time, stateDictCase = start
+   if output is None: output = list(stateDict.keys())
+   names = ['time'] + list(dict.fromkeys(list(output) + list(stateDict.keys())))
+
+   dt = simulationTime/options['ncp']
+   chunks = queue.Queue(maxsize=ahead)
+   cancel = threading.Event()
+   state = {'buffer': [], 'next': k, 'last': -np.inf}
+
+   def put(chunk):
+      while not cancel.is_set():
+         try:
+            chunks.put(chunk, timeout=0.1)
+            return
+         except queue.Full:
+            pass
+
+   def flush():
+      if len(state['buffer']) > 0:
+         chunk = {name: np.concatenate([piece[name] for piece in state['buffer']]) for name in names}
+         state['buffer'] = []
+         if len(chunk['time']) > 0:
+            state['last'] = chunk['time'][-1]
+            put(chunk)
+
+   def step_finished(time, piece):
+      state['buffer'].append(piece)
+      if (time - start_time)/dt >= state['next'] - 1e-9:
+         state['next'] = state['next'] + k
+         flush()
+      return not cancel.is_set()
+
+   def produce():
+      try:
+         res = simu_case(dict(parDict), simulationTime, names[1:], options, start_time, stateDictCase,
+                         step_finished, keep=False)
+         if not cancel.is_set():
+            after = res['time'] > state['last']
+            state['buffer'].append({name: res[name][after] for name in names})
+            flush()
+         put(None)
+      except Exception as error:
+         put(error)
+
+   producer = threading.Thread(target=produce, daemon=True)
+   producer.start()
+   last = None
+   try:
+      while True:
+         chunk = chunks.get()
+         if chunk is None: break
+         if isinstance(chunk, Exception): raise chunk
+         last = chunk
+         yield {name: chunk[name] for name in ['time'] + list(output)}
+   finally:
+      cancel.set()
+      producer.join()
+
+   if last is not None:
+      sim_res = last
+      for key in stateDict.keys(): stateDict[key] = float(last[key][-1])
+      prevFinalTime = float(last['time'][-1])
+      simu_checkpoint()
+
+# Progressive refinement: a coarse run shown at once and the full resolution run in the background
+global simu_refine; simu_refine = None
+
+def simu_result_use(res, diagrams=diagrams, linetype=None):
+   """Plot res with the diagrams and keep it as sim_res, with stateDict and prevFinalTime, as simu() does.
+      Returns the plotted lines and the line type."""
+   return fmu_session.result_use(res, diagrams, linetype)
+
+def simu_progressive(simulationTime=simulationTime, mode='Initial', options=opts_std, coarse=None, diagrams=diagrams,
+                     session=None):
+   """ Simulate as simu() but first with the coarse options, default 50 output points and relative
+       tolerance 1e-3, that are plotted at once, and then with options in the background. The plot,
+       sim_res, stateDict and prevFinalTime are replaced by the full resolution result when done, by a
+       timer of the figure with an interactive backend and otherwise at simu_refine_wait(). A new simu(),
+       par() or init() cancels a background run that is not done, see simu_refine_cancel().
+       Also simu(mode='progressive').
+       With session, an FMUSession, that session is simulated instead of the default session. """
+
+   global simu_refine
+   if session is None: session = fmu_session
+   simu_refine_cancel()
+
+   start = session.mode_start('Initial' if mode in ['Progressive', 'progressive'] else mode)
+   if start is None: return
+   start_time, stateDictCase = start
+   if coarse is None:
+      coarse = parareal_coarse(1e-3, options)
+      coarse['ncp'] = min(50, options['ncp'])
+
+   parDictCase = dict(session.parDict)
+   output = session.output(diagrams)
+   res = simu_case(parDictCase, simulationTime, output, coarse, start_time, stateDictCase)
+   lines, linetype = session.result_use(res, diagrams)
+
+   cancel = threading.Event()
+   refine = {'cancel': cancel, 'result': None, 'lines': lines, 'linetype': linetype, 'diagrams': diagrams,
+             'session': session}
+   def run():
+      try:
+         refine['result'] = simu_case(parDictCase, simulationTime, output, options, start_time, stateDictCase,
+                                      lambda time, chunk: not cancel.is_set())
+      except Exception as error:
+         print('Error: Full resolution run of simu_progressive() failed, the coarse result is kept -', error)
+   refine['thread'] = threading.Thread(target=run, daemon=True)
+   refine['thread'].start()
+   simu_refine = refine
+
+   if len(plt.get_fignums()) > 0:
+      refine['timer'] = plt.gcf().canvas.new_timer(interval=100)
+      refine['timer'].add_callback(simu_refine_apply)
+      refine['timer'].start()
+
+def simu_refine_apply():
+   """Replace the coarse result of simu_progressive() by the full resolution result if it is done"""
+   global simu_refine
+   refine = simu_refine
+   if (refine is None) or refine['thread'].is_alive(): return False
+   simu_refine = None
+   if 'timer' in refine.keys(): refine['timer'].stop()
+   if (refine['result'] is None) or refine['cancel'].is_set(): return False
+   for line in refine['lines']:
+      try:
+         line.remove()
+      except (ValueError, AttributeError, NotImplementedError):
+         pass
+   refine['session'].result_use(refine['result'], refine['diagrams'], refine['linetype'])
+   refine['session'].checkpoint()
+   if len(plt.get_fignums()) > 0: plt.gcf().canvas.draw_idle()
+   return True
+
+def simu_refine_wait(session=None):
+   """Wait for the background run of simu_progressive(), of session if given, and replace the coarse result"""
+   if (simu_refine is None) or ((session is not None) and (simu_refine['session'] is not session)): return False
+   simu_refine['thread'].join()
+   return simu_refine_apply()
+
+def simu_refine_cancel(session=None):
+   """Stop the background run of simu_progressive(), of session if given, if not done, and keep the coarse
+      result with a warning, since simu() in mode 'cont' then continues from the coarse states. A run
+      that is done replaces the coarse result as by simu_refine_apply()."""
+   global simu_refine
+   refine = simu_refine
+   if (refine is None) or ((session is not None) and (refine['session'] is not session)): return
+   if not refine['thread'].is_alive():
+      simu_refine_apply()
+      return
+   simu_refine = None
+   refine['cancel'].set()
+   if 'timer' in refine.keys(): refine['timer'].stop()
+   refine['thread'].join()
+   print("Warning: Full resolution run of simu_progressive() cancelled, sim_res, stateDict and prevFinalTime")
+   print("         are from the coarse run and simu() in mode 'cont' continues from there")
+
+# Conditions that end a simulation early
+global sim_stop; sim_stop = None
+global stop_comparisons
+stop_comparisons = {'<=': np.less_equal, '>=': np.greater_equal, '<': np.less, '>': np.greater, '==': np.equal,
+                    '!=': np.not_equal}
+
+def simu_stop_conditions(stop):
+   """Conditions as 'feedtank.V <= 0' or 'bioreactor.c[2] > 5', a string or a list, parsed into a list of
+      dictionaries with the condition, the variable, the comparison and the value, or None if not understood"""
+   names = set([variable.name for variable in model_description.modelVariables])
+   conditions = []
+   for condition in ([stop] if isinstance(stop, str) else stop):
+      match = re.fullmatch(r'\s*(\S+?)\s*(<=|>=|==|!=|<|>)\s*(\S+)\s*', condition)
+      if match is None:
+         print('Error:', condition, '- not a condition as variable <= value')
+         return None
+      name, comparison, value = match.groups()
+      if name not in names:
+         print('Error:', name, '- seems not a variable in the model - check the spelling')
+         return None
+      try:
+         value = float(value)
+      except ValueError:
+         print('Error:', value, '- not a number in', condition)
+         return None
+      conditions.append({'condition': condition.strip(), 'name': name, 'compare': stop_comparisons[comparison],
+                         'value': value})
+   return conditions
+
+def simu_stop_split(res):
+   """Result of simu_case() with stop as the dictionary of arrays and the record of the condition that ended
+      it and its time, kept apart so that sim_res and the sweep results have only arrays"""
+   if res is None: return None, {'stop': None, 'stop_time': None}
+   record = {'stop': res.get('stop'), 'stop_time': res.get('stop_time')}
+   return {key: value for key, value in res.items() if key not in record.keys()}, record
+
+def simu_stop_step(conditions, record, step_finished=None):
+   """Function for step_finished of simu_case() that ends the simulation at the first sample where one of
+      the conditions holds, and keeps the condition and the time of that sample in record"""
+   def step(time, chunk):
+      first = None
+      for condition in conditions:
+         holds = condition['compare'](chunk[condition['name']], condition['value'])
+         if np.any(holds) and ((first is None) or (chunk['time'][np.argmax(holds)] < first[1])):
+            first = (condition['condition'], float(chunk['time'][np.argmax(holds)]))
+      if first is not None:
+         record['stop'], record['stop_time'] = first
+         return False
+      return True if step_finished is None else step_finished(time, chunk)
+   return step
+
+def simu_mode_start(mode):
+   """Start time and states of a simulation in mode 'Initial' or 'cont' as by simu(), or None with an error"""
+   return fmu_session.mode_start(mode)
+
+def simu_stop(simulationTime=simulationTime, mode='Initial', options=opts_std, stop=[], diagrams=diagrams,
+              session=None):
+   """ Simulate as simu() but end at the first sample where one of the conditions in stop holds, e.g.
+       simu(stop=['feedtank.V <= 0', 'bioreactor.c[2] > 5']). The condition that ended the simulation
+       and its time are kept in sim_stop['stop'] and sim_stop['stop_time'], or None if none held, and
+       sim_res has the arrays as after simu(). """
+   if session is None: session = fmu_session
+   start = session.mode_start(mode)
+   if start is None: return None
+   output = session.output(diagrams)
+   res = simu_case(dict(session.parDict), simulationTime, output, options, start[0], start[1], stop=stop)
+   if res is None: return None
+   res, record = simu_stop_split(res)
+   session.result_use(res, diagrams)
+   session.sim_stop = record
+   session.checkpoint()
+   if record['stop'] is not None:
+      print('Simulation stopped at time', np.round(record['stop_time'], 4), 'where', record['stop'])
+   return res
+
+# Solver profiles tuned for accuracy versus speed
+global solver_profiles; solver_profiles = {}
+
+def solver_candidates(simulationTime=simulationTime, options=opts_std):
+   """Solver settings tried by solver_tune(): CVode with a range of relative tolerances, and Euler on
+      the output grid and finer ones. Euler of FMPy takes one step per output interval. The absolute
+      tolerance and the largest step of CVode are not options of FMPy: the absolute tolerance is the
+      relative one times the nominal values of the states and the largest step a fiftieth of the
+      simulation time."""
+   candidates = []
+   for tolerance in [1e-2, 1e-3, 1e-4, 1e-5, 1e-6, 1e-7, 1e-8]:
+      opts = dict(options)
+      opts.update({'solver': 'CVode', 'relative_tolerance': tolerance})
+      candidates.append(('CVode rtol ' + '{:.0e}'.format(tolerance), opts))
+   for division in [1, 4, 16]:
+      opts = dict(options)
+      opts.update({'solver': 'Euler', 'ncp': options['ncp']*division, 'step_size': simulationTime/options['ncp']/division})
+      candidates.append(('Euler step ' + '{:.1e}'.format(opts['step_size']), opts))
+   return candidates
+
+def solver_reference(options=opts_std):
+   """Settings of the tight tolerance reference of solver_tune()"""
+   opts = dict(options)
+   opts.update({'solver': 'CVode', 'relative_tolerance': 1e-10})
+   return opts
+
+def solver_tune(simulationTime=simulationTime, targets={'interactive': 1e-2, 'sweep': 1e-4, 'reference': 1e-7},
+                candidates=None, repeats=3, margin=0.2, options=opts_std, verbose=True):
+   """ Simulate parDict with each of the candidates, default solver_candidates(), and measure the runtime,
+       the best of repeats, and the error against a tight tolerance reference from solver_reference().
+       The error is the largest deviation of the states relative to their range over the simulation.
+       For each name in targets the candidates with at most that error count as equally fast when their
+       runtime is within the timing noise of the fastest, the typical spread of the repeats plus the
+       fraction margin of its runtime. Of those the loosest one, with the largest error, is kept in
+       solver_profiles, so that timing noise does not pick needlessly tight settings. If no candidate
+       meets a target the most accurate one is kept.
+       The profiles are options for simu(), e.g. simu(options='sweep') or
+       simu(options=solver_profiles['interactive']), and for the other functions. """
+
+   global solver_profiles
+   if flag_type not in ['ME', 'me']:
+      print('Error: Solver tuning only for FMU-ME')
+      return None
+   if candidates is None: candidates = solver_candidates(simulationTime, options)
+   states = list(stateDict.keys())
+
+   reference = simu_case(dict(parDict), simulationTime, states, solver_reference(options))
+   span = {name: max(np.ptp(reference[name]), 1e-12) for name in states}
+
+   results = []
+   for label, opts in candidates:
+      runtimes = []
+      try:
+         for k in range(repeats):
+            tic = time.time()
+            res = simu_case(dict(parDict), simulationTime, states, opts)
+            runtimes.append(time.time() - tic)
+         error = max([np.max(np.abs(np.interp(reference['time'], res['time'], res[name]) - reference[name]))/span[name]
+                      for name in states])
+      except Exception:
+         runtimes, error = [np.inf], np.inf
+      if not np.isfinite(error): error = np.inf
+      results.append({'label': label, 'options': opts, 'runtime': min(runtimes),
+                      'spread': max(runtimes) - min(runtimes), 'error': error})
+   spreads = [result['spread'] for result in results if np.isfinite(result['spread'])]
+   noise = np.median(spreads) if len(spreads) > 0 else 0.0
+
+   profiles = {}
+   for name, target in targets.items():
+      within = [result for result in results if result['error'] <= target]
+      if len(within) > 0:
+         fastest = min([result['runtime'] for result in within])
+         profiles[name] = max([result for result in within if result['runtime'] <= (1 + margin)*fastest + noise],
+                              key=lambda result: result['error'])
+      else:
+         profiles[name] = min(results, key=lambda result: result['error'])
+   solver_profiles.update({name: profile['options'] for name, profile in profiles.items()})
+
+   if verbose:
+      print()
+      print('Solver settings for', simulationTime, 'time units, error of the states relative to their range')
+      print('Timing noise', '{:.4f}'.format(noise), 's and margin', margin, 'of the fastest runtime')
+      for result in sorted(results, key=lambda result: result['runtime']):
+         print(' -' + result['label'].ljust(30), 'runtime', '{:7.4f}'.format(result['runtime']), 's  error',
+               '{:.1e}'.format(result['error']))
+      print('Profiles in solver_profiles:')
+      for name, profile in profiles.items():
+         print(' -' + name.ljust(12), ':', profile['label'], ' error', '{:.1e}'.format(profile['error']),
+               '(target', '{:.0e}'.format(targets[name]) + ')')
+   return {'results': results, 'profiles': {name: profile['label'] for name, profile in profiles.items()},
+           'reference': reference}
+
+def solver_profile(name):
+   """Options of the solver profile name from solver_tune(), or None with an error"""
+   if name not in solver_profiles.keys():
+      print('Error:', name, '- not a solver profile, run solver_tune() first, available are', list(solver_profiles.keys()))
+      return None
+   return solver_profiles[name]
+
 #------------------------------------------------------------------------------------------------------------------
 #  Startup
 #------------------------------------------------------------------------------------------------------------------